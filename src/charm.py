@@ -1,64 +1,237 @@
 #!/usr/bin/env python3
 
+import collections
+import json
+import os
+import re
 import ops
 import logging
+import opentelemetry.trace
+import string
+import time
+from pathlib import Path
 
 from charms.data_platform_libs.v0.data_interfaces import DatabaseCreatedEvent
 from charms.data_platform_libs.v0.data_interfaces import DatabaseRequires
 
-from charms.prometheus_k8s.v0.prometheus_scrape import MetricsEndpointProvider
-from charms.loki_k8s.v0.loki_push_api import LogProxyConsumer
-from charms.grafana_k8s.v0.grafana_dashboard import GrafanaDashboardProvider
+# the observability libraries (prometheus_scrape, loki_push_api, grafana_dashboard,
+# tracing & parca_scrape) are imported in `__init__`, only when their relation is involved
+
+import cpu_profile
+import load_test
+from hook_timings import HookTimings, timed
+from hook_tool_stats import HookToolStats
 
 # log messages can be retrieved using juju debug-log
 logger = logging.getLogger(__name__)
+# ops already traces the dispatch, the observers, the hook tools & the Pebble calls,
+# these spans add the charm's own steps around them
+tracer = opentelemetry.trace.get_tracer(__name__)
+
+# default listen port of postgres_exporter
+POSTGRES_EXPORTER_PORT = 9187
+# postgres_exporter is shipped in the charm (see the 'postgres-exporter' part) &
+# pushed into the workload container there, only once it's enabled
+POSTGRES_EXPORTER_PATH = '/srv/postgres-exporter/postgres_exporter'
+
+# seconds after which a lookup of the db host is given up, so that a slow resolver doesn't stall the hook
+DB_RESOLVE_TIMEOUT = 5
+
+# tmpfs-backed dir in which the workers write their metrics when there's more than one
+PROMETHEUS_MULTIPROC_DIR = '/dev/shm/prometheus-multiproc'
+# the aggregated metrics of all the workers are served on this port, unless 'metrics-port' is set
+DEFAULT_METRICS_PORT = 9100
+METRICS_AGGREGATOR_SCRIPT = '/srv/metrics_aggregator.py'
+
+# uvicorn logging config, pushed into the container when rotation or buffering is enabled
+LOGGING_CONFIG_PATH = '/srv/logging.json'
+# the log file tailed by promtail (see LogProxyConsumer)
+LOG_FILE = 'demo_server.log'
+# the service LogProxyConsumer injects, in a layer named after the container
+PROMTAIL_SERVICE_NAME = 'promtail'
+# the ASGI wrapper logging the requests, served in place of the app when the request logging is customised
+REQUEST_LOGGING_DIR = '/srv'
+# the charm's modules loaded into the workload processes (e.g. the heap snapshots module) are pushed
+# there, next to `workload_sitecustomize.py` as `sitecustomize.py`, & the dir is prepended to PYTHONPATH
+SITE_MODULES_DIR = '/srv/site-modules'
+# where the workload processes write the comparisons of their heap snapshots
+MEMORY_PROFILES_DIR = '/srv/profiles'
+# where the workload processes write their sampled stacks, for the one serving the pprof profiles
+PROFILING_STACKS_DIR = '/dev/shm/pprof-profiling'
+# how long the 'profile-memory' action waits for the workload processes to write their snapshots
+MEMORY_PROFILES_TIMEOUT = 30
+
+# number of timings kept per dispatched hook & per observer
+HOOK_TIMINGS_SIZE = 100
+# the hook timings are served from this dir in the workload container, when 'hook-metrics-port' is set
+HOOK_METRICS_DIR = '/srv/charm-metrics'
+
+# the alert & recording rules shipped with the charm, some of them are templated on the config
+ALERT_RULES_TEMPLATES = Path(__file__).parent / 'prometheus_alert_rules'
 
 class FastAPIDemoCharm(ops.CharmBase):
     """
     Charm the service
     """
 
+    _stored = ops.StoredState()
+
     def __init__(self, framework: ops.Framework) -> None:
         super().__init__(framework)
+        self._dispatch_start = time.monotonic()
+        # the backend runs the hook tools, there's no public way to instrument it
+        self.hook_tool_stats = (
+            HookToolStats(self.model._backend) if self.config['instrument-hook-tools'] else None
+        )
+        # the resolved addresses of the db host & when they were resolved
+        self._stored.set_default(db_host='', db_addrs='', db_resolved_at=0.0)
+        # the extensions probed on the db, as a JSON object of name -> enabled
+        self._stored.set_default(db_extensions='{}')
+        # the latest wall times of the dispatches & observers, see `HookTimings`
+        self._stored.set_default(hook_timings='{}', hook_timings_totals='{}')
+        self.hook_timings = HookTimings(
+            self._stored.hook_timings, size=HOOK_TIMINGS_SIZE, totals=self._stored.hook_timings_totals
+        )
+        self.hook_metrics_service_name = "charm-metrics"
 
         self.pebble_service_name = "fastapi-service"
+        self.aggregator_service_name = "metrics-aggregator"
         self.container = self.unit.get_container("demo-server")
+        self.exporter_service_name = "postgres-exporter"
         # the 'relation_name': comes from the 'charmcraft.yaml file'
         # the 'database_name': name of the db that the app requires
-        self.database = DatabaseRequires(self, relation_name="database", database_name="names_db")
-        self._prometheus_scraping = MetricsEndpointProvider(
+        # the 'relations_aliases': one alias per shard, as many as the relation 'limit' allows
+        self.database = DatabaseRequires(
             self,
-            relation_name="metrics-endpoint",
-            jobs=[{"static_configs": [{"targets": [f"*:{self.config['server-port']}"]}]}],
-            refresh_event=self.on.config_changed,
+            relation_name="database",
+            database_name="names_db",
+            relations_aliases=self.shard_aliases,
         )
-        self._logging = LogProxyConsumer(
-            self, relation_name="log-proxy", log_files=["demo_server.log"]
-        )
-        self._grafana_dashboards = GrafanaDashboardProvider(self, relation_name="grafana-dashboard")
+        # the observability libraries take a good share of the dispatch cold start,
+        # so they're only imported & set up when their relation exists or is dispatched
+        self._prometheus_scraping = None
+        if self._relation_involved("metrics-endpoint"):
+            from charms.prometheus_k8s.v0.prometheus_scrape import MetricsEndpointProvider
+            self._prometheus_scraping = MetricsEndpointProvider(
+                self,
+                relation_name="metrics-endpoint",
+                jobs=self._scrape_jobs,
+                alert_rules_path=self._render_alert_rules(),
+                refresh_event=self.on.config_changed,
+            )
+        # with 'pebble' log forwarding, Pebble pushes the service logs to Loki itself
+        # & promtail isn't injected into the workload container
+        self._logging = None
+        if self.config['log-forwarding'] != 'pebble' and self._relation_involved("log-proxy"):
+            from charms.loki_k8s.v0.loki_push_api import LogProxyConsumer
+            self._logging = LogProxyConsumer(
+                self, relation_name="log-proxy", log_files=[LOG_FILE]
+            )
+        self._grafana_dashboards = None
+        if self._relation_involved("grafana-dashboard"):
+            from charms.grafana_k8s.v0.grafana_dashboard import GrafanaDashboardProvider
+            self._grafana_dashboards = GrafanaDashboardProvider(self, relation_name="grafana-dashboard")
+        self.tracing = None
+        if self._relation_involved("tracing"):
+            from charms.tempo_coordinator_k8s.v0.tracing import TracingEndpointRequirer
+            self.tracing = TracingEndpointRequirer(self, relation_name="tracing", protocols=["otlp_http"])
+        # the charm's own spans go to the same backend as the workload's
+        endpoint = self.tracing.get_endpoint('otlp_http') if self.tracing and self.tracing.is_ready() else None
+        ops.tracing.set_destination(url=f'{endpoint}/v1/traces' if endpoint else None, ca=None)
+        self._profiling = None
+        if self._relation_involved("profiling-endpoint"):
+            from charms.parca_k8s.v0.parca_scrape import ProfilingEndpointProvider
+            self._profiling = ProfilingEndpointProvider(
+                self,
+                relation_name="profiling-endpoint",
+                jobs=self._profiling_jobs,
+                refresh_event=self.on.config_changed,
+            )
 
         framework.observe(self.on.demo_server_pebble_ready, self._on_demo_server_pebble_ready)
         framework.observe(self.on.config_changed, self._on_config_changed)
+        framework.observe(self.on.update_status, self._on_update_status)
+
+        framework.observe(self.on.leader_elected, self._on_peers_changed)
+        framework.observe(self.on['fastapi-peers'].relation_joined, self._on_peers_changed)
+        framework.observe(self.on['fastapi-peers'].relation_departed, self._on_peers_changed)
+        framework.observe(self.on['fastapi-peers'].relation_changed, self._on_peers_changed)
         
         framework.observe(self.database.on.database_created, self._on_database_created)
         framework.observe(self.database.on.endpoints_changed, self._on_database_created)
+        for alias in self.shard_aliases:
+            framework.observe(
+                getattr(self.database.on, f"{alias}_database_created"), self._on_shard_changed
+            )
+            framework.observe(
+                getattr(self.database.on, f"{alias}_endpoints_changed"), self._on_shard_changed
+            )
         
+        framework.observe(self.on['log-proxy'].relation_changed, self._on_log_proxy_changed)
+        framework.observe(self.on['log-proxy'].relation_departed, self._on_log_proxy_changed)
+        framework.observe(self.on['log-proxy'].relation_broken, self._on_log_proxy_changed)
+
+        if self.tracing:
+            framework.observe(self.tracing.on.endpoint_changed, self._on_tracing_changed)
+            framework.observe(self.tracing.on.endpoint_removed, self._on_tracing_changed)
+
+        framework.observe(self.on['profiling-endpoint'].relation_joined, self._on_profiling_changed)
+        framework.observe(self.on['profiling-endpoint'].relation_broken, self._on_profiling_changed)
+
         framework.observe(self.on.collect_unit_status, self._on_collect_status)
         
         framework.observe(self.on.get_db_info_action, self._on_get_db_info_action)
+        framework.observe(self.on.perf_report_action, self._on_perf_report_action)
+        framework.observe(self.on.load_test_action, self._on_load_test_action)
+        framework.observe(self.on.profile_cpu_action, self._on_profile_cpu_action)
+        framework.observe(self.on.profile_memory_action, self._on_profile_memory_action)
 
-    @property
-    def _pebble_layer(self) -> ops.pebble.Layer:
+        framework.observe(framework.on.pre_commit, self._on_pre_commit)
+
+    def _relation_involved(self, relation_name: str) -> bool:
+        """
+        Whether the relation exists or the dispatched hook is one of its events
+        (a broken relation is already left out of the model's relations).
+        """
+        return bool(self.model.relations[relation_name]) or os.environ.get('JUJU_RELATION') == relation_name
+
+    def _pebble_layer(self, plan: ops.pebble.Plan) -> ops.pebble.Layer:
         """
-        A Pebble layer for the FastAPI demo services.
+        A Pebble layer for the FastAPI demo services, on top of the current `plan`.
         """
 
-        command = ' '.join([
+        workers = self.config['workers']
+        request_logging = self._request_logging_environment
+        args = [
             'uvicorn',
-            'api_demo_server.app:app',
+            'request_logging:app' if request_logging else 'api_demo_server.app:app',
             '--host=0.0.0.0',
             f"--port={self.config['server-port']}",
-        ])
+        ]
+        if request_logging:
+            # the wrapper logs the (sampled) requests instead of uvicorn
+            args.extend([f'--app-dir={REQUEST_LOGGING_DIR}', '--no-access-log'])
+        if workers > 1:
+            args.append(f'--workers={workers}')
+        if self._logging_config:
+            args.append(f'--log-config={LOGGING_CONFIG_PATH}')
+        command = ' '.join(args)
+        environment = {**self.app_environment, **request_logging}
+        metrics_port = self.metrics_port
+
+        # the shell commands run before the workload
+        setup = []
+        if metrics_port:
+            # the metrics files of the previous run are removed on every (re)start
+            setup += [f'rm -rf {PROMETHEUS_MULTIPROC_DIR}', f'mkdir -p {PROMETHEUS_MULTIPROC_DIR}']
+            environment['PROMETHEUS_MULTIPROC_DIR'] = PROMETHEUS_MULTIPROC_DIR
+        site_modules = self._site_modules
+        if site_modules:
+            # prepended to the PYTHONPATH of the image rather than replacing it
+            setup.append(f'export PYTHONPATH={SITE_MODULES_DIR}${{PYTHONPATH:+:$PYTHONPATH}}')
+            environment['DEMO_SERVER_SITE_MODULES'] = ','.join(site_modules)
+        if setup:
+            command = f"/bin/sh -c '{' && '.join(setup)} && exec {command}'"
 
         pebble_layer: ops.pebble.LayerDict = {
             'summary': 'FastAPI demo service',
@@ -69,13 +242,399 @@ class FastAPIDemoCharm(ops.CharmBase):
                     'summary': 'fastapi demo',
                     'command': command,
                     'startup': 'enabled',
-                    'environment': self.app_environment
+                    'environment': environment
                 }
             }
         }
 
+        if metrics_port:
+            pebble_layer['services'][self.aggregator_service_name] = {
+                'override': 'replace',
+                'summary': 'aggregated prometheus metrics of the fastapi workers',
+                'command': f'python3 {METRICS_AGGREGATOR_SCRIPT} {metrics_port}',
+                'startup': 'enabled',
+                'after': [self.pebble_service_name],
+                'environment': {'PROMETHEUS_MULTIPROC_DIR': PROMETHEUS_MULTIPROC_DIR},
+            }
+        else:
+            aggregator = plan.services.get(self.aggregator_service_name)
+            if aggregator and aggregator.startup != 'disabled':
+                # back to a single worker, the aggregator mustn't be started by the next replans
+                pebble_layer['services'][self.aggregator_service_name] = {'override': 'merge', 'startup': 'disabled'}
+
+        log_targets = self._log_targets(plan)
+        if log_targets:
+            pebble_layer['log-targets'] = log_targets
+
         return ops.pebble.Layer(pebble_layer)
 
+    @property
+    def _request_logging_environment(self) -> dict[str, str]:
+        """
+        Env variables of the request logging wrapper, from the 'access-log-sample-rate',
+        'log-format' & 'slow-request-threshold' config.
+        It's empty if the requests are logged by uvicorn as usual.
+        """
+        sample_rate = self.config['access-log-sample-rate']
+        log_format = self.config['log-format']
+        slow_threshold = self.config['slow-request-threshold']
+        if sample_rate >= 1 and log_format == 'text' and not slow_threshold:
+            return {}
+
+        return {
+            'DEMO_SERVER_ACCESS_LOG_SAMPLE_RATE': str(sample_rate),
+            'DEMO_SERVER_LOG_FORMAT': log_format,
+            'DEMO_SERVER_SLOW_REQUEST_THRESHOLD': str(slow_threshold),
+        }
+
+    @property
+    def _logging_config(self) -> dict | None:
+        """
+        A logging dictConfig for uvicorn & the app, which writes the logs to the file
+        tailed by promtail with size-based rotation and/or through a memory buffer.
+        With 'pebble' log forwarding, the logs are also written unbuffered to stderr,
+        which is what Pebble forwards.
+        It's None if neither rotation nor buffering is configured.
+        """
+        rotate_size = self.config['log-rotate-size']
+        buffer_size = self.config['log-buffer-size']
+        if not rotate_size and not buffer_size:
+            return None
+
+        handlers = {
+            'file': {
+                'class': 'logging.FileHandler',
+                'filename': LOG_FILE,
+                'formatter': 'default',
+            },
+        }
+        if rotate_size:
+            handlers['file'].update({
+                'class': 'logging.handlers.RotatingFileHandler',
+                'maxBytes': rotate_size * 1024 * 1024,
+                'backupCount': self.config['log-rotate-count'],
+            })
+        if buffer_size:
+            # records are written in batches, or right away from ERROR on
+            handlers['buffered'] = {
+                'class': 'logging.handlers.MemoryHandler',
+                'capacity': buffer_size,
+                # a level name is only taken by dictConfig from Python 3.13 on
+                'flushLevel': logging.ERROR,
+                'target': 'file',
+            }
+        root_handlers = ['buffered' if buffer_size else 'file']
+        if self.config['log-forwarding'] == 'pebble':
+            handlers['console'] = {
+                'class': 'logging.StreamHandler',
+                'formatter': 'default',
+            }
+            root_handlers.append('console')
+
+        return {
+            'version': 1,
+            'disable_existing_loggers': False,
+            'formatters': {
+                'default': {'format': '%(asctime)s %(levelname)s %(name)s %(message)s'},
+            },
+            'handlers': handlers,
+            'root': {
+                'level': 'INFO',
+                'handlers': root_handlers,
+            },
+        }
+
+    def _log_targets(self, plan: ops.pebble.Plan) -> dict[str, ops.pebble.LogTargetDict]:
+        """
+        Pebble log targets pushing the service logs to the Loki endpoints of the
+        log-proxy relation, when 'log-forwarding' is 'pebble'. The targets that are
+        already in the (current) plan but aren't needed anymore are disabled.
+        """
+        endpoints = self.loki_endpoints if self.config['log-forwarding'] == 'pebble' else []
+        labels = {
+            'juju_model': self.model.name,
+            'juju_model_uuid': self.model.uuid,
+            'juju_application': self.app.name,
+            'juju_unit': self.unit.name,
+            'juju_charm': self.meta.name,
+            **self.log_labels,
+        }
+
+        targets: dict[str, ops.pebble.LogTargetDict] = {
+            f'loki-{index}': {
+                'override': 'replace',
+                'type': 'loki',
+                'location': endpoint,
+                'services': [self.pebble_service_name],
+                'labels': labels,
+            }
+            for index, endpoint in enumerate(endpoints)
+        }
+
+        for name in plan.log_targets:
+            if name.startswith('loki-') and name not in targets:
+                targets[name] = {'override': 'merge', 'services': ['-all']}
+
+        return targets
+
+    @property
+    def loki_endpoints(self) -> list[str]:
+        """
+        Push API URLs published by the Loki units in the log-proxy relation.
+        """
+        endpoints = []
+        for relation in self.model.relations['log-proxy']:
+            for unit in relation.units:
+                endpoint = relation.data[unit].get('endpoint')
+                if endpoint:
+                    endpoints.append(json.loads(endpoint)['url'])
+
+        return sorted(endpoints)
+
+    @property
+    def log_labels(self) -> dict[str, str]:
+        """
+        Extra labels of the forwarded logs, from the 'log-labels' config ("key=value,...").
+        """
+        return dict(
+            label.strip().split('=', 1)
+            for label in self.config['log-labels'].split(',')
+            if '=' in label
+        )
+
+    @property
+    def _exporter_layer(self) -> ops.pebble.Layer | None:
+        """
+        A Pebble layer for the postgres_exporter service, next to the workload.
+        It connects to the database using the credentials of the database relation.
+        It's None if the exporter is disabled or the database isn't available.
+        """
+
+        if not self.config['enable-postgres-exporter']:
+            return None
+        db_data = self.fetch_postgres_relation_data()
+        if not db_data:
+            return None
+
+        environment = {
+            'DATA_SOURCE_URI': (
+                f"{db_data['db_host']}:{db_data['db_port']}/{self.database.database}"
+                '?sslmode=disable'
+            ),
+            'DATA_SOURCE_USER': db_data['db_username'],
+            'DATA_SOURCE_PASS': db_data['db_password'],
+        }
+
+        pebble_layer: ops.pebble.LayerDict = {
+            'summary': 'postgres_exporter service',
+            'description': 'pebble config layer for postgres_exporter',
+            'services': {
+                self.exporter_service_name: {
+                    'override': 'replace',
+                    'summary': 'postgres exporter',
+                    'command': f'{POSTGRES_EXPORTER_PATH} --web.listen-address=:{POSTGRES_EXPORTER_PORT}',
+                    'startup': 'enabled',
+                    'environment': environment,
+                }
+            }
+        }
+
+        return ops.pebble.Layer(pebble_layer)
+
+    @property
+    def metrics_port(self) -> int | None:
+        """
+        Port on which the metrics are served outside the request workers.
+        It's None when the (single) worker serves them on the server port itself.
+        """
+        if self.config['metrics-port']:
+            return self.config['metrics-port']
+        # with several workers, each scrape of the server port would land on a random one
+        if self.config['workers'] > 1:
+            return DEFAULT_METRICS_PORT
+        return None
+
+    @property
+    def _profiling_jobs(self) -> list[dict]:
+        """
+        Profiling job of the workload. Its sampling profiler only serves the CPU profile.
+        """
+        return [{
+            "static_configs": [{"targets": [f"*:{self.config['profiling-port']}"]}],
+            "profiling_config": {
+                "pprof_config": {
+                    "memory": {"enabled": False},
+                    "block": {"enabled": False},
+                    "goroutine": {"enabled": False},
+                    "mutex": {"enabled": False},
+                    "process_cpu": {"enabled": True, "path": "/debug/pprof/profile", "delta": True},
+                },
+            },
+        }]
+
+    @property
+    def _scrape_jobs(self) -> list[dict]:
+        """
+        Scrape jobs for the workload & postgres_exporter (if enabled).
+        The scrape interval & timeout are only set if they're configured.
+        """
+        scrape_config = {
+            key: self.config[option]
+            for key, option in {
+                "scrape_interval": "scrape-interval",
+                "scrape_timeout": "scrape-timeout",
+            }.items()
+            if self.config[option]
+        }
+
+        port = self.metrics_port or self.config['server-port']
+        jobs = [
+            {
+                "metrics_path": self.config['metrics-path'],
+                "static_configs": [{"targets": [f"*:{port}"]}],
+                **scrape_config,
+            }
+        ]
+
+        if self.config['hook-metrics-port']:
+            jobs.append(
+                {
+                    "job_name": "charm-hooks",
+                    "metrics_path": "/metrics.txt",
+                    "static_configs": [{"targets": [f"*:{self.config['hook-metrics-port']}"]}],
+                    **scrape_config,
+                }
+            )
+
+        if self.config['enable-postgres-exporter']:
+            jobs.append(
+                {
+                    "job_name": "postgres-exporter",
+                    "static_configs": [{"targets": [f"*:{POSTGRES_EXPORTER_PORT}"]}],
+                    **scrape_config,
+                }
+            )
+
+        return jobs
+
+    def _render_alert_rules(self) -> str:
+        """
+        Render the alert rules templates with the SLO thresholds from the config.
+        The rendered rules are written to the charm dir (only if they have changed)
+        & the function returns that dir.
+        """
+        objective = self.config['availability-objective']
+        thresholds = {
+            'availability_objective': str(objective),
+            'error_budget': f'{1 - objective:g}',
+            'latency_p99_target': str(self.config['latency-p99-target']),
+        }
+
+        rendered = self.charm_dir / 'prometheus_alert_rules'
+        rendered.mkdir(exist_ok=True)
+        for template in ALERT_RULES_TEMPLATES.glob('*.rules'):
+            rules = string.Template(template.read_text()).safe_substitute(thresholds)
+            path = rendered / template.name
+            if not path.exists() or path.read_text() != rules:
+                path.write_text(rules)
+
+        return str(rendered)
+
+    @property
+    def shard_aliases(self) -> list[str]:
+        """
+        Aliases of the database relations, one per shard (shard0..shardN).
+        The number of shards is the 'limit' of the database relation in 'charmcraft.yaml'.
+        """
+        limit = self.meta.requires['database'].limit or 1
+        return [f'shard{index}' for index in range(limit)]
+
+    @property
+    def db_extensions(self) -> list[str]:
+        """
+        Names of the db extensions to probe, from the 'db-extensions' config.
+        """
+        return [name.strip() for name in self.config['db-extensions'].split(',') if name.strip()]
+
+    @property
+    def unit_indices(self) -> dict[str, int]:
+        """
+        Ordinals of the units (unit name -> index) handed out by the leader
+        in the peer relation app databag.
+        """
+        relation = self.model.get_relation('fastapi-peers')
+        if not relation:
+            return {}
+        return json.loads(relation.data[self.app].get('unit-indices', '{}'))
+
+    @property
+    def tracing_environment(self) -> dict[str, str]:
+        """
+        OpenTelemetry env variables of the app, pointing it to the OTLP endpoint
+        of the tracing relation. It's empty if the relation isn't ready.
+        """
+        if not self.tracing or not self.tracing.is_ready():
+            return {}
+
+        topology = {
+            'juju_model': self.model.name,
+            'juju_model_uuid': self.model.uuid,
+            'juju_application': self.app.name,
+            'juju_unit': self.unit.name,
+            'juju_charm': self.meta.name,
+        }
+
+        return {
+            'OTEL_EXPORTER_OTLP_ENDPOINT': self.tracing.get_endpoint('otlp_http'),
+            'OTEL_EXPORTER_OTLP_PROTOCOL': 'http/protobuf',
+            'OTEL_SERVICE_NAME': self.app.name,
+            'OTEL_RESOURCE_ATTRIBUTES': ','.join(f'{key}={value}' for key, value in topology.items()),
+            'OTEL_TRACES_SAMPLER': 'parentbased_traceidratio',
+            'OTEL_TRACES_SAMPLER_ARG': str(self.config['tracing-sample-rate']),
+        }
+
+    @property
+    def profiling_environment(self) -> dict[str, str]:
+        """
+        Env variables of the sampling profiler module, which serves pprof profiles on
+        'profiling-port' once it's loaded. It's empty if the profiling relation isn't set.
+        """
+        if not self.model.relations['profiling-endpoint']:
+            return {}
+
+        return {
+            'DEMO_SERVER_PROFILING_PORT': str(self.config['profiling-port']),
+            'DEMO_SERVER_PROFILING_SAMPLE_RATE': str(self.config['profiling-sample-rate']),
+            'DEMO_SERVER_PROFILING_DIR': PROFILING_STACKS_DIR,
+        }
+
+    @property
+    def _site_modules(self) -> list[str]:
+        """
+        The charm's modules loaded into the workload processes by `workload_sitecustomize.py`
+        """
+        modules = []
+        if self.model.relations['profiling-endpoint']:
+            modules.append('pprof_profiling')
+        if self.config['memory-profiling-frames']:
+            modules.append('memory_profiling')
+        return modules
+
+    @property
+    def memory_profiling_environment(self) -> dict[str, str]:
+        """
+        Env variables of the heap snapshots module, whose processes trace their allocations
+        once it's loaded. It's empty if 'memory-profiling-frames' is 0.
+        """
+        frames = self.config['memory-profiling-frames']
+        if not frames:
+            return {}
+
+        return {
+            'DEMO_SERVER_TRACEMALLOC_FRAMES': str(frames),
+            'DEMO_SERVER_MEMORY_PROFILES_DIR': MEMORY_PROFILES_DIR,
+        }
+
     @property
     def app_environment(self) -> dict[str, str]:
         """
@@ -83,12 +642,21 @@ class FastAPIDemoCharm(ops.CharmBase):
         It retrieves the db auth data by calling the `fetch_postgres_relation_data`
         method & uses it to populate the dict. If any value isn't present
         it will be set to None. The method returns the dict as output.
+        The data of the database relations is fetched once for both the primary & the shards.
         """
-        db_data = self.fetch_postgres_relation_data()
+        env = {**self.tracing_environment, **self.profiling_environment, **self.memory_profiling_environment}
+
+        unit_indices = self.unit_indices
+        if self.unit.name in unit_indices:
+            env["DEMO_SERVER_UNIT_INDEX"] = str(unit_indices[self.unit.name])
+            env["DEMO_SERVER_UNIT_COUNT"] = str(len(unit_indices))
+
+        relations = self._fetch_database_relation_data()
+        db_data = self.fetch_postgres_relation_data(relations)
         if not db_data:
-            return {}
+            return env
         
-        env = {
+        env.update({
             key: value
             for key, value in {
                 "DEMO_SERVER_DB_HOST": db_data.get("db_host", None),
@@ -97,7 +665,22 @@ class FastAPIDemoCharm(ops.CharmBase):
                 "DEMO_SERVER_DB_PASSWORD": db_data.get("db_password", None),
             }.items()
             if value is not None
-        }
+        })
+
+        shards = self.fetch_postgres_shards(relations)
+        if shards:
+            env["DEMO_SERVER_DB_SHARDS"] = json.dumps(shards, sort_keys=True)
+
+        extensions = json.loads(self._stored.db_extensions)
+        for extension in self.db_extensions:
+            if extension in extensions:
+                # e.g. 'uuid-ossp' -> DEMO_SERVER_DB_EXT_UUID_OSSP
+                name = re.sub('[^A-Z0-9]', '_', extension.upper())
+                env[f"DEMO_SERVER_DB_EXT_{name}"] = str(extensions[extension]).lower()
+
+        if self.config['resolve-db-host'] and self._stored.db_host == db_data['db_host']:
+            if self._stored.db_addrs:
+                env["DEMO_SERVER_DB_ADDRS"] = self._stored.db_addrs
 
         return env
     
@@ -110,25 +693,182 @@ class FastAPIDemoCharm(ops.CharmBase):
         """
 
         self.unit.status = ops.MaintenanceStatus('Assembling Pebble layers')
+        with tracer.start_as_current_span('update_layer_and_restart'):
+            try:
+                if self.metrics_port:
+                    aggregator = Path(__file__).parent / 'metrics_aggregator.py'
+                    self.container.push(METRICS_AGGREGATOR_SCRIPT, aggregator.read_text(), make_dirs=True)
+
+                if self._request_logging_environment:
+                    request_logging = Path(__file__).parent / 'request_logging.py'
+                    self.container.push(
+                        f'{REQUEST_LOGGING_DIR}/request_logging.py', request_logging.read_text(), make_dirs=True
+                    )
+
+                if self._site_modules:
+                    sitecustomize = Path(__file__).parent / 'workload_sitecustomize.py'
+                    self.container.push(
+                        f'{SITE_MODULES_DIR}/sitecustomize.py', sitecustomize.read_text(), make_dirs=True
+                    )
+                    for module in self._site_modules:
+                        self.container.push(
+                            f'{SITE_MODULES_DIR}/{module}.py',
+                            (Path(__file__).parent / f'{module}.py').read_text(),
+                            make_dirs=True,
+                        )
+
+                logging_config_changed = self._push_logging_config()
+
+                plan = self.container.get_plan()
+                self._update_promtail(plan)
+                if not self.config['hook-metrics-port']:
+                    self._disable_service('charm_metrics', self.hook_metrics_service_name, plan)
+                layer = self._pebble_layer(plan)
+                self.container.add_layer('fastapi_demo', layer, combine=True)
+                logger.info("Added updated layer 'fastapi_demo' to Pebble plan")
+
+                # tell Pebble to incorporate the changes, including restarting the service if required
+                self.container.replan()
+                logger.info(f"Replanned with '{self.pebble_service_name}' service")
+
+                # the aggregator has just been disabled, it's stopped once the workload has restarted
+                aggregator = layer.services.get(self.aggregator_service_name)
+                if aggregator and aggregator.startup == 'disabled':
+                    self.container.stop(self.aggregator_service_name)
+                    logger.info(f"Stopped '{self.aggregator_service_name}' service")
+
+                # the logging config is only read on startup
+                if logging_config_changed:
+                    self.container.restart(self.pebble_service_name)
+                    logger.info(f"Restarted '{self.pebble_service_name}' service with new logging config")
+
+                self.unit.status = ops.ActiveStatus()
+            except (ops.pebble.APIError, ops.pebble.ConnectionError):
+                logger.debug('Waiting for Pebble in workload container')
+
+    def _push_logging_config(self) -> bool:
+        """
+        Push the logging config into the workload container if it has changed.
+        The function returns whether it has changed.
+        """
+        logging_config = self._logging_config
+        if not logging_config:
+            return False
+
+        content = json.dumps(logging_config, indent=2, sort_keys=True)
+        try:
+            if self.container.pull(LOGGING_CONFIG_PATH).read() == content:
+                return False
+        except ops.pebble.PathError:
+            pass
+
+        self.container.push(LOGGING_CONFIG_PATH, content, make_dirs=True)
+        logger.info('Pushed logging config to %s', LOGGING_CONFIG_PATH)
+        return True
+
+    def _push_hook_metrics(self) -> None:
+        """
+        Write the hook timings as a Prometheus textfile in the workload container,
+        served by a plain HTTP server next to the workload.
+        """
+        port = self.config['hook-metrics-port']
+        layer: ops.pebble.LayerDict = {
+            'summary': 'charm hook timings',
+            'description': 'pebble config layer serving the hook timings of the charm',
+            'services': {
+                self.hook_metrics_service_name: {
+                    'override': 'replace',
+                    'summary': 'charm hook timings',
+                    'command': f'python3 -m http.server {port} --directory {HOOK_METRICS_DIR}',
+                    'startup': 'enabled',
+                }
+            }
+        }
+
         try:
-            self.container.add_layer('fastapi_demo', self._pebble_layer, combine=True)
-            logger.info("Added updated layer 'fastapi_demo' to Pebble plan")
+            self.container.push(
+                f'{HOOK_METRICS_DIR}/metrics.txt', self.hook_timings.to_prometheus(), make_dirs=True
+            )
+            plan = self.container.get_plan().services.get(self.hook_metrics_service_name)
+            # the service is disabled while 'hook-metrics-port' is 0
+            if (
+                not plan
+                or plan.startup == 'disabled'
+                or plan.command != layer['services'][self.hook_metrics_service_name]['command']
+            ):
+                self.container.add_layer('charm_metrics', ops.pebble.Layer(layer), combine=True)
+                self.container.replan()
+        except (ops.pebble.APIError, ops.pebble.ConnectionError):
+            logger.debug('Waiting for Pebble in workload container')
 
-            # tell Pebble to incorporate the changes, including restarting the service if required
-            self.container.replan()
-            logger.info(f"Replanned with '{self.pebble_service_name}' service")
+    def _update_exporter(self) -> None:
+        """
+        Start postgres_exporter in the workload container if it's enabled & the database
+        is available. Otherwise the service is disabled in the plan, so that no replan
+        starts it again, & stopped.
+        """
 
-            self.unit.status = ops.ActiveStatus()
+        try:
+            layer = self._exporter_layer
+            if layer:
+                if not self.container.exists(POSTGRES_EXPORTER_PATH):
+                    with open(self.charm_dir / 'bin' / 'postgres_exporter', 'rb') as binary:
+                        self.container.push(POSTGRES_EXPORTER_PATH, binary, permissions=0o755, make_dirs=True)
+                    logger.info('Pushed postgres_exporter to %s', POSTGRES_EXPORTER_PATH)
+                self.container.add_layer('postgres_exporter', layer, combine=True)
+                self.container.replan()
+                logger.info(f"Replanned with '{self.exporter_service_name}' service")
+            elif self._disable_service('postgres_exporter', self.exporter_service_name, self.container.get_plan()):
+                logger.info(f"Stopped '{self.exporter_service_name}' service")
         except (ops.pebble.APIError, ops.pebble.ConnectionError):
             logger.debug('Waiting for Pebble in workload container')
 
+    def _update_promtail(self, plan: ops.pebble.Plan) -> None:
+        """
+        With 'pebble' log forwarding, disable the promtail service that LogProxyConsumer
+        injected with 'promtail' log forwarding, or the logs would be pushed to Loki twice.
+        It's enabled again when switching back to 'promtail'.
+        """
+        if self.config['log-forwarding'] == 'pebble':
+            if self._disable_service(self.container.name, PROMTAIL_SERVICE_NAME, plan):
+                logger.info(f"Stopped '{PROMTAIL_SERVICE_NAME}' service, Pebble forwards the logs")
+            return
+
+        service = plan.services.get(PROMTAIL_SERVICE_NAME)
+        if service and service.startup == 'disabled':
+            layer: ops.pebble.LayerDict = {
+                'services': {PROMTAIL_SERVICE_NAME: {'override': 'merge', 'startup': 'enabled'}},
+            }
+            # started by the replan
+            self.container.add_layer(self.container.name, ops.pebble.Layer(layer), combine=True)
+
+    def _disable_service(self, label: str, service_name: str, plan: ops.pebble.Plan) -> bool:
+        """
+        Override the service as disabled in the layer `label` & stop it, if it's enabled
+        in the (current) `plan`. The function returns whether it was enabled.
+        """
+        service = plan.services.get(service_name)
+        if not service or service.startup == 'disabled':
+            return False
+
+        layer: ops.pebble.LayerDict = {
+            'services': {service_name: {'override': 'merge', 'startup': 'disabled'}},
+        }
+        self.container.add_layer(label, ops.pebble.Layer(layer), combine=True)
+        if any(service.is_running() for service in self.container.get_services(service_name).values()):
+            self.container.stop(service_name)
+        return True
+
+    @timed
     def _on_demo_server_pebble_ready(self, event: ops.PebbleReadyEvent) -> None:
         """
         Define & start a workload using the Pebble API
         """
 
         self._update_layer_and_restart()
+        self._update_exporter()
     
+    @timed
     def _on_config_changed(self, event: ops.ConfigChangedEvent) -> None:
         port = self.config["server-port"]
 
@@ -137,22 +877,94 @@ class FastAPIDemoCharm(ops.CharmBase):
             logger.debug('Invalid port number: 22 is reserved for SSH')
     
         logger.debug("New application port is requested: %s", port)
+        self.refresh_db_addresses()
+        # the extensions already probed are kept, until the list of extensions changes
+        if self.database.relations and set(self.db_extensions) != set(json.loads(self._stored.db_extensions)):
+            self.probe_db_extensions()
         self._update_layer_and_restart()
+        self._update_exporter()
 
+    @timed
     def _on_database_created(self, event: DatabaseCreatedEvent) -> None:
         """ event is fired when postgres is created """
+        self.refresh_db_addresses(force=True)
+        self.probe_db_extensions()
+        self._update_layer_and_restart()
+        self._update_exporter()
+
+    @timed
+    def _on_update_status(self, event: ops.UpdateStatusEvent) -> None:
+        """
+        Re-resolve the db host once its addresses are older than 'db-resolve-ttl'
+        & restart the workload only if they have changed
+        """
+        if self.refresh_db_addresses():
+            self._update_layer_and_restart()
+
+    @timed
+    def _on_peers_changed(self, event: ops.EventBase) -> None:
+        """
+        event is fired when units join or leave the app, or the leader changes.
+        The leader re-assigns the unit ordinals & every unit passes its own to the workload
+        """
+        relation = self.model.get_relation('fastapi-peers')
+        if not relation:
+            return
+
+        if self.unit.is_leader():
+            departing_unit = getattr(event, 'departing_unit', None)
+            units = {self.unit.name} | {unit.name for unit in relation.units}
+            if departing_unit:
+                units.discard(departing_unit.name)
+            indices = self.assign_unit_indices(self.unit_indices, units)
+            relation.data[self.app]['unit-indices'] = json.dumps(indices, sort_keys=True)
+
         self._update_layer_and_restart()
+
+    @timed
+    def _on_log_proxy_changed(self, event: ops.RelationEvent) -> None:
+        """
+        event is fired when the Loki endpoints change, Pebble forwards the logs to them
+        """
+        if self.config['log-forwarding'] == 'pebble':
+            self._update_layer_and_restart()
+
+    @timed
+    def _on_profiling_changed(self, event: ops.RelationEvent) -> None:
+        """ event is fired when the profiling backend is related or removed """
+        self._update_layer_and_restart()
+
+    @timed
+    def _on_tracing_changed(self, event: ops.RelationEvent) -> None:
+        """ event is fired when the OTLP endpoint of the tracing relation changes """
+        self._update_layer_and_restart()
+
+    @timed
+    def _on_shard_changed(self, event: DatabaseCreatedEvent) -> None:
+        """
+        event is fired for the aliased relation of a shard, after the unaliased
+        `database_created`/`endpoints_changed` event has already refreshed the shard map
+        """
+        alias = event.relation.data[self.unit].get('alias')
+        logger.info('Database for shard %s is available at %s', alias, event.endpoints)
     
+    @timed
     def _on_collect_status(self, event: ops.CollectStatusEvent) -> None:
         port = self.config['server-port']
 
         if port == 22:
             event.add_status(ops.BlockedStatus('Invalid port number, port 22 is reserved for SSH'))
 
-        if not self.model.get_relation('database'):
+        if self.config['log-format'] not in ('text', 'json'):
+            event.add_status(ops.BlockedStatus("Invalid log-format, use 'text' or 'json'"))
+
+        if self.config['log-forwarding'] not in ('promtail', 'pebble'):
+            event.add_status(ops.BlockedStatus("Invalid log-forwarding, use 'promtail' or 'pebble'"))
+
+        if not self.model.relations['database']:
             # need the user to do 'juju integrate'
             event.add_status(ops.BlockedStatus('Waiting for database relation'))
-        elif not self.database.fetch_relation_data():
+        elif not self._fetch_database_relation_data():
             # need the charms to finish integrating
             event.add_status(ops.WaitingStatus('Waiting for database relation'))
         
@@ -163,10 +975,19 @@ class FastAPIDemoCharm(ops.CharmBase):
         else:
             if not status.is_running():
                 event.add_status(ops.MaintenanceStatus('Waiting for the service to start up'))
+
+        if self.config['enable-postgres-exporter'] and self.fetch_postgres_relation_data():
+            try:
+                running = self.container.get_service(self.exporter_service_name).is_running()
+            except (ops.pebble.APIError, ops.pebble.ConnectionError, ops.ModelError):
+                running = False
+            if not running:
+                event.add_status(ops.MaintenanceStatus('Waiting for postgres_exporter to start up'))
         
         # if nothing is wrong, then status is active
         event.add_status(ops.ActiveStatus())
     
+    @timed
     def _on_get_db_info_action(self, event: ops.ActionEvent) -> None:
         """
         Called when "get_db_info" action is called. It shows info about
@@ -198,38 +1019,371 @@ class FastAPIDemoCharm(ops.CharmBase):
         
         event.set_results(output)
 
+    @timed
+    def _on_perf_report_action(self, event: ops.ActionEvent) -> None:
+        """
+        Called when "perf-report" action is called. It shows the count, p50, p95 & max
+        wall time (in seconds) of the latest dispatches of each hook & runs of each observer.
+        """
+        event.set_results({
+            re.sub('[^a-z0-9]+', '-', key.lower()).strip('-'): {
+                stat: str(value) for stat, value in stats.items()
+            }
+            for key, stats in self.hook_timings.report().items()
+        })
+
+    @timed
+    def _on_load_test_action(self, event: ops.ActionEvent) -> None:
+        """
+        Called when "load-test" action is called. It sends requests to the 'path' of the
+        'target' (the local workload by default) for 'duration' seconds & shows the
+        throughput, the errors & the latency percentiles (in milliseconds).
+        """
+        target = event.params['target'] or f"http://localhost:{self.config['server-port']}"
+        url = f"{target.rstrip('/')}/{event.params['path'].lstrip('/')}"
+        event.log(f"Sending requests to {url} for {event.params['duration']}s")
+
+        try:
+            result = load_test.run(
+                url,
+                duration=event.params['duration'],
+                concurrency=event.params['concurrency'],
+                rps=event.params['rps'],
+            )
+        except ValueError as e:
+            event.fail(str(e))
+            return
+
+        event.set_results({
+            key: {name: str(stat) for name, stat in value.items()} if isinstance(value, dict) else str(value)
+            for key, value in result.items()
+        })
+
+    @timed
+    def _on_profile_cpu_action(self, event: ops.ActionEvent) -> None:
+        """
+        Called when "profile-cpu" action is called. It samples the uvicorn workers with
+        py-spy for 'duration' seconds, saves the collapsed stacks in the workload container
+        & shows their path & the 'top' frames with the most samples of their own.
+        """
+        duration = event.params['duration']
+        path = f"{cpu_profile.PROFILES_DIR}/cpu-{time.strftime('%Y%m%d-%H%M%S')}.txt"
+
+        try:
+            # py-spy runs as a child of Pebble, with its capabilities
+            if not cpu_profile.has_ptrace(self.container.pull('/proc/self/status').read()):
+                event.fail('The workload container lacks the SYS_PTRACE capability needed by py-spy')
+                return
+            # the workload image has no pgrep, the processes are found in /proc
+            cmdlines = {}
+            for info in self.container.list_files('/proc', pattern='[0-9]*'):
+                try:
+                    cmdlines[int(info.name)] = self.container.pull(f'{info.path}/cmdline', encoding=None).read()
+                except ops.pebble.PathError:
+                    # the process is gone
+                    continue
+        except (ops.pebble.APIError, ops.pebble.ConnectionError, ops.pebble.PathError) as e:
+            event.fail(f'Failed to find the uvicorn process: {e}')
+            return
+        pid = cpu_profile.main_pid(cmdlines)
+        if not pid:
+            event.fail('The uvicorn process is not running')
+            return
+
+        try:
+            if not self.container.exists(cpu_profile.PY_SPY_PATH):
+                with open(self.charm_dir / 'bin' / 'py-spy', 'rb') as binary:
+                    self.container.push(cpu_profile.PY_SPY_PATH, binary, permissions=0o755, make_dirs=True)
+                logger.info('Pushed py-spy to %s', cpu_profile.PY_SPY_PATH)
+            self.container.make_dir(cpu_profile.PROFILES_DIR, make_parents=True)
+            event.log(f'Sampling process {pid} & its workers for {duration}s')
+            self.container.exec(
+                cpu_profile.record_command(pid, duration, event.params['rate'], path),
+                timeout=duration + 60,
+            ).wait_output()
+            collapsed = self.container.pull(path).read()
+            self._prune_cpu_profiles()
+        except FileNotFoundError:
+            event.fail('py-spy is missing from the charm')
+            return
+        except ops.pebble.ExecError as e:
+            event.fail(f'py-spy failed: {(e.stderr or e.stdout or "").strip()}')
+            return
+        except (ops.pebble.APIError, ops.pebble.ChangeError, ops.pebble.ConnectionError, ops.pebble.PathError) as e:
+            event.fail(f'Failed to profile the workload: {e}')
+            return
+
+        samples, frames = cpu_profile.top_frames(collapsed, event.params['top'])
+        event.set_results({
+            'path': path,
+            'samples': str(samples),
+            'top-frames': {
+                str(rank): f'{frame}: self {self_count / samples:.1%}, total {total_count / samples:.1%}'
+                for rank, (frame, self_count, total_count) in enumerate(frames, 1)
+            },
+        })
+
+    @timed
+    def _on_profile_memory_action(self, event: ops.ActionEvent) -> None:
+        """
+        Called when "profile-memory" action is called. It signals the workload processes
+        to take a baseline heap snapshot, then to compare another one to it 'interval' seconds
+        later, & shows the 'top' allocation sites & object types by growth in between, over all
+        the processes.
+        """
+        if not self.config['memory-profiling-frames']:
+            event.fail("Memory profiling is disabled, set the 'memory-profiling-frames' config first")
+            return
+
+        interval = event.params['interval']
+        try:
+            # the signals terminate a process without the heap snapshots module, e.g. if the
+            # service wasn't restarted since the config was set
+            service = self.container.get_plan().services.get(self.pebble_service_name)
+            environment = service.environment if service else {}
+            site_modules = environment.get('DEMO_SERVER_SITE_MODULES', '').split(',')
+            if 'DEMO_SERVER_TRACEMALLOC_FRAMES' not in environment or 'memory_profiling' not in site_modules:
+                event.fail('The workload runs without memory profiling, wait for it to restart with the config')
+                return
+            # the comparisons of a previous (e.g. failed) run
+            self.container.make_dir(MEMORY_PROFILES_DIR, make_parents=True)
+            for info in self.container.list_files(MEMORY_PROFILES_DIR, pattern='memory-*.json'):
+                self.container.remove_path(info.path)
+            # a new baseline replaces any previous one
+            self.container.send_signal('SIGUSR1', self.pebble_service_name)
+            started = time.time()
+            event.log(f'Took the baseline snapshots, taking the next ones in {interval}s')
+            time.sleep(interval)
+            self.container.send_signal('SIGUSR2', self.pebble_service_name)
+            profiles = self._wait_memory_profiles(started)
+        except (ops.pebble.APIError, ops.pebble.ConnectionError, ops.pebble.PathError) as e:
+            event.fail(f'Failed to take the heap snapshots: {e}')
+            return
+
+        if not profiles:
+            event.fail(f'No heap snapshot was written within {MEMORY_PROFILES_TIMEOUT}s')
+            return
+
+        sites, counts, types = collections.Counter(), collections.Counter(), collections.Counter()
+        for profile in profiles:
+            for site in profile['sites']:
+                sites[site['site']] += site['size_diff']
+                counts[site['site']] += site['count_diff']
+            types.update(profile['types'])
+
+        top = event.params['top']
+        event.set_results({
+            'processes': str(len(profiles)),
+            'growth': f"{sum(profile['size_diff'] for profile in profiles) / 1024:+.1f} KiB",
+            'top-sites': {
+                str(rank): f'{site}: {size / 1024:+.1f} KiB in {counts[site]:+d} blocks'
+                for rank, (site, size) in enumerate(sites.most_common(top), 1)
+            },
+            'top-types': {
+                str(rank): f'{name}: {count:+d}'
+                for rank, (name, count) in enumerate(types.most_common(top), 1)
+            },
+        })
+
+    def _prune_cpu_profiles(self) -> None:
+        """
+        Remove all but the latest `cpu_profile.PROFILES_KEPT` CPU profiles of the workload container
+        """
+        # the names sort by the time they were taken
+        profiles = sorted(
+            info.path for info in self.container.list_files(cpu_profile.PROFILES_DIR, pattern='cpu-*.txt')
+        )
+        for path in profiles[:-cpu_profile.PROFILES_KEPT]:
+            self.container.remove_path(path)
+            logger.debug('Removed the old CPU profile %s', path)
+
+    def _wait_memory_profiles(self, started: float) -> list[dict]:
+        """
+        The heap snapshot comparisons written by the workload processes since `started`,
+        once there's one per process or after `MEMORY_PROFILES_TIMEOUT` seconds
+        """
+        workers = self.config['workers']
+        # with several workers, the main uvicorn process takes snapshots too
+        expected = workers + 1 if workers > 1 else 1
+        deadline = time.monotonic() + MEMORY_PROFILES_TIMEOUT
+
+        while True:
+            profiles = []
+            for info in self.container.list_files(MEMORY_PROFILES_DIR, pattern='memory-*.json'):
+                profile = json.loads(self.container.pull(info.path).read())
+                if profile['ended'] >= started:
+                    profiles.append(profile)
+            if len(profiles) >= expected or time.monotonic() >= deadline:
+                return profiles
+            time.sleep(1)
+
+    def _on_pre_commit(self, event: ops.PreCommitEvent) -> None:
+        """
+        event is fired at the end of every dispatch, before the charm state is saved.
+        It records the wall time of the dispatch & saves the timings, which are
+        pushed to the workload container when a hook ran a timed observer.
+        """
+        dispatch_path = os.environ.get('JUJU_DISPATCH_PATH', '')
+        # the status is collected on every dispatch, so it doesn't count as handling the hook
+        handled = not dispatch_path.startswith('actions/') and any(
+            not key.startswith('collect_') for key in self.hook_timings.recorded
+        )
+        hook = dispatch_path.split('/')[-1] or 'unknown'
+        self.hook_timings.record(f'dispatch/{hook}', time.monotonic() - self._dispatch_start)
+        self._stored.hook_timings = self.hook_timings.dumps()
+        self._stored.hook_timings_totals = self.hook_timings.dumps_totals()
+
+        if self.hook_tool_stats:
+            self.hook_tool_stats.log_summary()
+
+        if self.config['hook-metrics-port'] and handled:
+            self._push_hook_metrics()
+
     # ----- end of event handlers/hooks -----
 
     # ----- util methods -----
-    def fetch_postgres_relation_data(self) -> dict[str, str]:
+    def fetch_postgres_relation_data(self, relations: dict[int, dict[str, str]] | None = None) -> dict[str, str]:
         """
         Fetch postgres relation data
 
         The function retrieves relation data from a postgres database using
-        the `fetch_relation_data` method of the `database` object. The retrieved data
+        the `fetch_relation_data` method of the `database` object, unless the data
+        of the relations already fetched is passed in `relations`. The retrieved data
         is logged for debugging purposes and any non-empty data is processed to extract
         endpoint info (username & password). The processed data is returned as a dict.
         If no data is retrieved, the unit is set to waiting status & the program
         exits with a zero status code.
         """
-        relations = self.database.fetch_relation_data()
+        if relations is None:
+            relations = self._fetch_database_relation_data()
         logger.debug('Got following database data: %s', relations)
 
         for data in relations.values():
             if not data:
                 continue
             logger.info('New PSQL database endpoint is %s', data['endpoints'])
-            host, port = data['endpoints'].split(':')
-            db_data = {
-                'db_host': host,
-                'db_port': port,
-                'db_username': data['username'],
-                'db_password': data['password']
-            }
-
-            return db_data
+            return self._parse_db_data(data)
 
         return {}
+
+    def _fetch_database_relation_data(self) -> dict[int, dict[str, str]]:
+        """
+        Fetch the data of all the database relations, in a span of its own
+        """
+        with tracer.start_as_current_span('DatabaseRequires.fetch_relation_data'):
+            return self.database.fetch_relation_data()
+
+    def fetch_postgres_shards(self, relations: dict[int, dict[str, str]] | None = None) -> dict[str, dict[str, str]]:
+        """
+        Fetch the connection info of every database shard
+
+        Each database relation gets an alias (shard0..shardN) from the library when
+        it's created. The function maps every aliased relation that already shared
+        its credentials to its endpoint info. Relations without an alias are left out.
+        The data of the relations already fetched can be passed in `relations`.
+        """
+        if relations is None:
+            relations = self._fetch_database_relation_data()
+
+        shards = {}
+        for relation in self.database.relations:
+            alias = relation.data[self.unit].get('alias')
+            data = relations.get(relation.id)
+            if not alias or not data:
+                continue
+            shards[alias] = self._parse_db_data(data)
+
+        return shards
+
+    @staticmethod
+    def assign_unit_indices(indices: dict[str, int], units: set[str]) -> dict[str, int]:
+        """
+        Assign each unit an ordinal in range(len(units))
+
+        Units keep the ordinal they already had while it's still in range, so a scale
+        event only moves the units that joined & the ones whose ordinal is now too big.
+        These take the free ordinals, lowest first.
+        """
+        assigned = {
+            unit: index for unit, index in indices.items() if unit in units and index < len(units)
+        }
+        free = sorted(set(range(len(units))) - set(assigned.values()))
+        for unit in sorted(units - assigned.keys()):
+            assigned[unit] = free.pop(0)
+
+        return assigned
+
+    def refresh_db_addresses(self, force: bool = False) -> bool:
+        """
+        Resolve the IP addresses of the db host
+
+        The addresses are kept in the charm state & passed to the workload, so that
+        it doesn't need a DNS lookup for every connection. They're resolved again when
+        the db host changes, when `force` is set or once they are older than the
+        'db-resolve-ttl' config. The lookup runs in the workload container, with the
+        DNS view of the workload, & is given up after `DB_RESOLVE_TIMEOUT` seconds.
+        If it fails, the previous addresses are kept.
+        The function returns whether the addresses have changed.
+        """
+        if not self.config['resolve-db-host']:
+            return False
+
+        db_data = self.fetch_postgres_relation_data()
+        if not db_data:
+            return False
+
+        host = db_data['db_host']
+        age = time.time() - self._stored.db_resolved_at
+        if not force and host == self._stored.db_host and age < self.config['db-resolve-ttl']:
+            return False
+
+        try:
+            # one "<address> <socket type> [<name>]" line per address & socket type
+            hosts, _ = self.container.exec(['getent', 'ahosts', host], timeout=DB_RESOLVE_TIMEOUT).wait_output()
+        except (ops.pebble.APIError, ops.pebble.ChangeError, ops.pebble.ConnectionError, ops.pebble.ExecError) as e:
+            logger.warning('Failed to resolve db host %s: %s', host, e)
+            return False
+
+        addrs = ','.join(sorted({line.split()[0] for line in hosts.splitlines() if line.strip()}))
+        if not addrs:
+            logger.warning('Failed to resolve db host %s: no address', host)
+            return False
+        changed = host != self._stored.db_host or addrs != self._stored.db_addrs
+        self._stored.db_host = host
+        self._stored.db_addrs = addrs
+        self._stored.db_resolved_at = time.time()
+        logger.debug('Resolved db host %s to %s', host, addrs)
+
+        return changed
+
+    def probe_db_extensions(self) -> None:
+        """
+        Check which of the 'db-extensions' are enabled in the database
+
+        Every probe opens a connection to the database, so the results are kept
+        in the charm state & only recomputed when the database is created, when its
+        endpoints change (`endpoints_changed` is observed by `_on_database_created`)
+        or when the 'db-extensions' config changes.
+        """
+        extensions = {
+            extension: self.database.is_postgresql_plugin_enabled(extension)
+            for extension in self.db_extensions
+        }
+        logger.debug('Probed db extensions: %s', extensions)
+        self._stored.db_extensions = json.dumps(extensions)
+
+    @staticmethod
+    def _parse_db_data(data: dict[str, str]) -> dict[str, str]:
+        """
+        Extract endpoint info (host, port, username & password) from relation data
+        """
+        host, port = data['endpoints'].split(':')
+        return {
+            'db_host': host,
+            'db_port': port,
+            'db_username': data['username'],
+            'db_password': data['password']
+        }
     # ----- end of util methods -----
     
 if __name__ == "__main__": # pragma: no cover
@@ -0,0 +1,80 @@
+"""
+Sampling CPU profiles of the uvicorn workers, taken by the 'profile-cpu' action
+
+py-spy, shipped with the charm & pushed into the workload container, is attached
+to the uvicorn process & its worker subprocesses without pausing them, which
+needs the CAP_SYS_PTRACE capability. The stacks are saved in the collapsed format
+("frame;frame;...;frame count" per line), which is what flame graph tools
+(flamegraph.pl, speedscope, ...) take as input.
+"""
+
+from collections import Counter
+
+# where the profiles are kept in the workload container
+PROFILES_DIR = '/srv/profiles'
+# the number of profiles kept there, the older ones are removed
+PROFILES_KEPT = 10
+# where py-spy is pushed in the workload container
+PY_SPY_PATH = '/srv/py-spy/py-spy'
+
+CAP_SYS_PTRACE = 19
+
+
+def has_ptrace(status: str) -> bool:
+    """
+    Whether the effective capabilities in a /proc/<pid>/status include CAP_SYS_PTRACE
+    """
+    for line in status.splitlines():
+        name, _, value = line.partition(':')
+        if name == 'CapEff':
+            return bool(int(value, 16) >> CAP_SYS_PTRACE & 1)
+    return False
+
+
+def main_pid(cmdlines: dict[int, bytes]) -> int | None:
+    """
+    The main uvicorn process among the /proc/<pid>/cmdline of the processes, by pid.
+    The oldest uvicorn process is the main one, its workers are subprocesses.
+    """
+    return min((pid for pid, cmdline in cmdlines.items() if b'uvicorn' in cmdline), default=None)
+
+
+def record_command(pid: int, duration: int, rate: int, output: str) -> list[str]:
+    """
+    The py-spy command sampling the process & its subprocesses `rate` times per second
+    for `duration` seconds, into `output` as collapsed stacks
+    """
+    return [
+        PY_SPY_PATH, 'record',
+        '--pid', str(pid),
+        '--subprocesses',
+        '--nonblocking',
+        '--duration', str(duration),
+        '--rate', str(rate),
+        '--format', 'raw',
+        '--output', output,
+    ]
+
+
+def top_frames(collapsed: str, top: int) -> tuple[int, list[tuple[str, int, int]]]:
+    """
+    Number of samples & the `top` frames with the most samples of their own, with their
+    own (self) & inclusive (total) number of samples
+    """
+    self_samples = Counter()
+    total_samples = Counter()
+    samples = 0
+    for line in collapsed.splitlines():
+        stack, _, count = line.rpartition(' ')
+        if not stack or not count.isdigit():
+            continue
+        frames = stack.split(';')
+        samples += int(count)
+        self_samples[frames[-1]] += int(count)
+        # a recursive frame only counts once per stack
+        for frame in set(frames):
+            total_samples[frame] += int(count)
+
+    return samples, [
+        (frame, count, total_samples[frame]) for frame, count in self_samples.most_common(top)
+    ]
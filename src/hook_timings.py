@@ -0,0 +1,118 @@
+"""
+Wall time of the charm's dispatches & observers
+
+The timings are kept per key (the dispatched hook or the event & its observer)
+in bounded ring buffers, which are serialised to JSON to live in the charm state.
+The count & sum of all the timings ever recorded are kept next to them, so that
+the Prometheus summary has monotonic `_count` & `_sum` series.
+"""
+
+import functools
+import json
+import math
+import time
+from collections import deque
+from typing import Callable
+
+
+class HookTimings:
+    """
+    Ring buffers of the latest durations (in seconds) of each key,
+    & the count & sum of all the durations of each key
+    """
+
+    def __init__(self, data: str, size: int, totals: str = '{}') -> None:
+        self._size = size
+        self._timings = {
+            key: deque(durations, maxlen=size) for key, durations in json.loads(data).items()
+        }
+        self._totals = {key: list(total) for key, total in json.loads(totals).items()}
+        # buffers saved before the totals were kept start them off
+        for key, durations in self._timings.items():
+            self._totals.setdefault(key, [len(durations), sum(durations)])
+        # the keys recorded by this instance, i.e. during this dispatch
+        self.recorded = set()
+
+    def record(self, key: str, duration: float) -> None:
+        """
+        Add a duration to the buffer of the key, dropping the oldest one if it's full,
+        & to its totals
+        """
+        duration = round(duration, 6)
+        self._timings.setdefault(key, deque(maxlen=self._size)).append(duration)
+        total = self._totals.setdefault(key, [0, 0.0])
+        total[0] += 1
+        total[1] = round(total[1] + duration, 6)
+        self.recorded.add(key)
+
+    def dumps(self) -> str:
+        """
+        Serialise the buffers to JSON
+        """
+        return json.dumps({key: list(durations) for key, durations in self._timings.items()})
+
+    def dumps_totals(self) -> str:
+        """
+        Serialise the count & sum of each key to JSON
+        """
+        return json.dumps(self._totals)
+
+    def report(self) -> dict[str, dict[str, float]]:
+        """
+        Count, p50, p95 & max duration of each key
+        """
+        report = {}
+        for key, durations in sorted(self._timings.items()):
+            ordered = sorted(durations)
+            report[key] = {
+                'count': len(ordered),
+                'p50': _percentile(ordered, 0.50),
+                'p95': _percentile(ordered, 0.95),
+                'max': ordered[-1],
+            }
+
+        return report
+
+    def to_prometheus(self) -> str:
+        """
+        Render the report in the Prometheus text format. The quantiles are those of the
+        latest durations, the count & sum those of all of them.
+        """
+        lines = [
+            '# HELP charm_hook_duration_seconds Wall time of the charm dispatches & observers',
+            '# TYPE charm_hook_duration_seconds summary',
+        ]
+        for key, stats in self.report().items():
+            labels = f'key="{key}"'
+            count, total = self._totals[key]
+            lines.append(f'charm_hook_duration_seconds{{{labels},quantile="0.5"}} {stats["p50"]}')
+            lines.append(f'charm_hook_duration_seconds{{{labels},quantile="0.95"}} {stats["p95"]}')
+            lines.append(f'charm_hook_duration_seconds{{{labels},quantile="1"}} {stats["max"]}')
+            lines.append(f'charm_hook_duration_seconds_sum{{{labels}}} {total}')
+            lines.append(f'charm_hook_duration_seconds_count{{{labels}}} {count}')
+
+        return '\n'.join(lines) + '\n'
+
+
+def _percentile(ordered: list[float], quantile: float) -> float:
+    """
+    Nearest-rank percentile of a sorted list
+    """
+    return ordered[max(math.ceil(quantile * len(ordered)) - 1, 0)]
+
+
+def timed(method: Callable) -> Callable:
+    """
+    Decorator recording the wall time of an observer in the `hook_timings` of the charm,
+    under the '<event kind>/<observer name>' key.
+    """
+
+    @functools.wraps(method)
+    def wrapper(self, event):
+        start = time.monotonic()
+        try:
+            return method(self, event)
+        finally:
+            self.hook_timings.record(f'{event.handle.kind}/{method.__name__}', time.monotonic() - start)
+
+    return wrapper
@@ -0,0 +1,112 @@
+"""
+Counts & times the hook tool calls made during a dispatch
+
+Every relation databag read or write and every secret access of ops ends up as a
+hook tool (a subprocess) run by the model backend. `HookToolStats` wraps the backend
+methods running these tools, to find out which code paths (e.g. in data_interfaces)
+make the most of them & how much time they take.
+
+`timed_calls` is the wrapping itself, which the benchmarks & the backend-call
+budget tests reuse on other methods (e.g. those of `ops.Container`).
+"""
+
+import logging
+import os
+import sys
+import time
+from collections import defaultdict
+from typing import Callable, Iterable
+
+logger = logging.getLogger(__name__)
+
+# the model backend methods that are instrumented & the hook tool each one runs
+HOOK_TOOLS = {
+    'relation_get': 'relation-get',
+    'relation_set': 'relation-set',
+    'secret_get': 'secret-get',
+    'secret_info_get': 'secret-info-get',
+    'secret_set': 'secret-set',
+}
+
+_OPS_DIR = os.path.dirname(sys.modules['ops'].__file__)
+
+
+def timed_calls(target, method_names: Iterable[str], record: Callable[[str, float], None]) -> dict:
+    """
+    Wrappers of the methods of `target` (an object or a class) calling
+    `record(method name, seconds)` after each call, by method name.
+    It's up to the caller to set them, e.g. with `setattr` or `monkeypatch.setattr`.
+    """
+    def wrap(name, method):
+        def wrapper(*args, **kwargs):
+            start = time.monotonic()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                record(name, time.monotonic() - start)
+
+        return wrapper
+
+    return {name: wrap(name, getattr(target, name)) for name in method_names}
+
+
+class HookToolStats:
+    """
+    Wraps the hook tool methods of a model backend to count & time their calls,
+    by kind of hook tool & by caller.
+    """
+
+    def __init__(self, backend) -> None:
+        self._calls = defaultdict(lambda: defaultdict(int))
+        self._durations = defaultdict(float)
+
+        for method_name, wrapper in timed_calls(backend, HOOK_TOOLS, self._record).items():
+            setattr(backend, method_name, wrapper)
+
+    def _record(self, method_name: str, seconds: float) -> None:
+        kind = HOOK_TOOLS[method_name]
+        self._durations[kind] += seconds
+        self._calls[kind][_caller()] += 1
+
+    def summary(self) -> dict[str, dict]:
+        """
+        Number of calls, total time (in seconds) & calls per caller of each kind of hook tool
+        """
+        return {
+            kind: {
+                'count': sum(callers.values()),
+                'seconds': round(self._durations[kind], 6),
+                'callers': dict(sorted(callers.items(), key=lambda item: -item[1])),
+            }
+            for kind, callers in sorted(self._calls.items())
+        }
+
+    def log_summary(self) -> None:
+        """
+        Log the summary of the hook tool calls made so far
+        """
+        for kind, stats in self.summary().items():
+            logger.info(
+                '%s: %d calls in %.3fs, by %s',
+                kind, stats['count'], stats['seconds'],
+                ', '.join(f'{caller} ({count})' for caller, count in stats['callers'].items()),
+            )
+
+
+def _caller() -> str:
+    """
+    The first function up the stack that isn't part of ops, of this module
+    or a frozen stdlib module (e.g. the `Mapping.get` of the relation data)
+    """
+    frame = sys._getframe(2)
+    while frame and (
+        frame.f_code.co_filename.startswith((_OPS_DIR, '<frozen'))
+        or frame.f_code.co_filename == __file__
+    ):
+        frame = frame.f_back
+    if not frame:
+        return 'unknown'
+
+    code = frame.f_code
+    name = getattr(code, 'co_qualname', code.co_name)
+    return f'{os.path.basename(code.co_filename)}:{name}'
@@ -0,0 +1,146 @@
+"""
+A bounded HTTP load generator, run by the 'load-test' action from the charm container
+
+`concurrency` threads send GET requests to a URL over keep-alive connections for
+`duration` seconds, optionally capped at `rps` requests per second in total, &
+the throughput, errors & latency percentiles of the responses are reported.
+"""
+
+import http.client
+import math
+import re
+import threading
+import time
+from collections import Counter
+from urllib.parse import urlsplit
+
+# bounds of the action params, so that a load test can't run away with the unit
+MAX_DURATION = 300
+MAX_CONCURRENCY = 64
+REQUEST_TIMEOUT = 10
+
+
+class RatePacer:
+    """
+    Hands out the send times of the requests of all the threads, `rps` per second
+    """
+
+    def __init__(self, rps: float) -> None:
+        self._interval = 1 / rps
+        self._next = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self) -> float:
+        """
+        Sleep until the next free send time & return it
+        """
+        with self._lock:
+            slot = max(self._next, time.monotonic())
+            self._next = slot + self._interval
+        time.sleep(max(slot - time.monotonic(), 0))
+        return slot
+
+
+def run(url: str, duration: float, concurrency: int, rps: float = 0, timeout: float = REQUEST_TIMEOUT) -> dict:
+    """
+    Load the URL & return the number of requests, the throughput (requests per second),
+    the errors by kind & the p50, p90, p99 & max latency (in milliseconds).
+    Responses with a 4xx or 5xx status & failed requests count as errors.
+    """
+    if not 0 < duration <= MAX_DURATION:
+        raise ValueError(f'duration must be between 1 & {MAX_DURATION} seconds')
+    if not 0 < concurrency <= MAX_CONCURRENCY:
+        raise ValueError(f'concurrency must be between 1 & {MAX_CONCURRENCY}')
+    if rps < 0:
+        raise ValueError('rps must be positive, or 0 for no cap')
+
+    target = urlsplit(url)
+    if target.scheme not in ('http', 'https') or not target.hostname:
+        raise ValueError(f'invalid URL {url!r}')
+
+    pacer = RatePacer(rps) if rps else None
+    start = time.monotonic()
+    deadline = start + duration
+    latencies = [[] for _ in range(concurrency)]
+    errors = [Counter() for _ in range(concurrency)]
+
+    threads = [
+        threading.Thread(
+            target=_worker, args=(target, deadline, pacer, timeout, latencies[index], errors[index]), daemon=True
+        )
+        for index in range(concurrency)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - start
+
+    ordered = sorted(latency for worker in latencies for latency in worker)
+    error_counts = sum(errors, Counter())
+    requests = len(ordered) + sum(count for kind, count in error_counts.items() if not kind.startswith('http-'))
+
+    return {
+        'requests': requests,
+        'duration': round(elapsed, 3),
+        'throughput': round(requests / elapsed, 2),
+        'errors': sum(error_counts.values()),
+        'error-kinds': dict(sorted(error_counts.items())),
+        'latency': {
+            name: round(_percentile(ordered, quantile) * 1000, 3) if ordered else 0.0
+            for name, quantile in (('p50', 0.50), ('p90', 0.90), ('p99', 0.99), ('max', 1.0))
+        },
+    }
+
+
+def _worker(target, deadline: float, pacer: RatePacer | None, timeout: float, latencies: list, errors: Counter) -> None:
+    """
+    Send requests on one keep-alive connection until the deadline, reconnecting after a failure
+    """
+    connection_class = http.client.HTTPSConnection if target.scheme == 'https' else http.client.HTTPConnection
+    path = target.path or '/'
+    if target.query:
+        path = f'{path}?{target.query}'
+
+    connection = None
+    while True:
+        send_at = pacer.wait() if pacer else time.monotonic()
+        if send_at >= deadline:
+            break
+
+        if connection is None:
+            connection = connection_class(target.hostname, target.port, timeout=timeout)
+        start = time.monotonic()
+        try:
+            connection.request('GET', path)
+            response = connection.getresponse()
+            response.read()
+        except (OSError, http.client.HTTPException) as e:
+            errors[_error_kind(e)] += 1
+            connection.close()
+            connection = None
+            continue
+
+        latencies.append(time.monotonic() - start)
+        if response.status >= 400:
+            errors[f'http-{response.status}'] += 1
+        if response.will_close:
+            connection.close()
+            connection = None
+
+    if connection is not None:
+        connection.close()
+
+
+def _error_kind(error: Exception) -> str:
+    """
+    Kebab-case name of the exception, e.g. 'connection-refused-error'
+    """
+    return re.sub('(?<!^)(?=[A-Z])', '-', type(error).__name__).lower()
+
+
+def _percentile(ordered: list[float], quantile: float) -> float:
+    """
+    Nearest-rank percentile of a sorted list
+    """
+    return ordered[max(math.ceil(quantile * len(ordered)) - 1, 0)]
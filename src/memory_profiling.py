@@ -0,0 +1,122 @@
+"""
+Heap snapshots of the workload processes, taken on SIGUSR1 & SIGUSR2
+
+This module is pushed into the workload container & loaded by `sitecustomize`
+when 'memory-profiling-frames' is set, on the start of the uvicorn process & of
+each of its workers. Every process traces its allocations with tracemalloc &
+takes a snapshot of them & of the number of objects per type:
+
+- on SIGUSR1, as the baseline, replacing the previous one if any
+- on SIGUSR2, which is compared to the baseline: the allocation sites & types
+  that grew the most are written to DEMO_SERVER_MEMORY_PROFILES_DIR/memory-<pid>.json
+  & the baseline is dropped. A process without a baseline (e.g. a worker started
+  in between) writes nothing.
+"""
+
+import gc
+import json
+import os
+import signal
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+
+FRAMES = int(os.environ.get('DEMO_SERVER_TRACEMALLOC_FRAMES', '0'))
+PROFILES_DIR = os.environ.get('DEMO_SERVER_MEMORY_PROFILES_DIR', '/srv/profiles')
+# allocation sites & object types kept per process
+TOP = 50
+# a process gets the signal both from Pebble & from its parent, only the first one counts
+DEBOUNCE = 1.0
+
+_baseline = None
+# when each signal was last handled
+_last_signals = {}
+_lock = threading.Lock()
+
+
+def _object_types() -> Counter:
+    return Counter(type(obj).__name__ for obj in gc.get_objects())
+
+
+def _snapshot() -> tuple:
+    snapshot = tracemalloc.take_snapshot().filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, __file__, all_frames=True),
+    ))
+    return time.time(), snapshot, _object_types()
+
+
+def _take_baseline() -> None:
+    """
+    Keep a snapshot as the baseline
+    """
+    global _baseline
+    current = _snapshot()
+    with _lock:
+        _baseline = current
+
+
+def _compare_to_baseline() -> None:
+    """
+    Write the comparison of a snapshot to the baseline & drop the baseline
+    """
+    global _baseline
+    with _lock:
+        baseline, _baseline = _baseline, None
+    if not baseline:
+        return
+    current = _snapshot()
+
+    started, before, types_before = baseline
+    ended, after, types_after = current
+    stats = [stat for stat in after.compare_to(before, 'traceback') if stat.size_diff > 0]
+    types = Counter(types_after)
+    types.subtract(types_before)
+
+    profile = {
+        'pid': os.getpid(),
+        'started': started,
+        'ended': ended,
+        'size_diff': sum(stat.size_diff for stat in stats),
+        'sites': [
+            {
+                # the allocating line first, then its callers
+                'site': ' <- '.join(f'{frame.filename}:{frame.lineno}' for frame in reversed(stat.traceback)),
+                'size_diff': stat.size_diff,
+                'count_diff': stat.count_diff,
+            }
+            for stat in sorted(stats, key=lambda stat: -stat.size_diff)[:TOP]
+        ],
+        'types': {name: count for name, count in types.most_common(TOP) if count > 0},
+    }
+
+    os.makedirs(PROFILES_DIR, exist_ok=True)
+    path = os.path.join(PROFILES_DIR, f'memory-{os.getpid()}.json')
+    with open(f'{path}.tmp', 'w') as file:
+        json.dump(profile, file)
+    os.replace(f'{path}.tmp', path)
+
+
+def _on_signal(signum, frame) -> None:
+    now = time.monotonic()
+    if now - _last_signals.get(signum, 0.0) < DEBOUNCE:
+        return
+    _last_signals[signum] = now
+
+    # the uvicorn workers are multiprocessing children of the main process
+    multiprocessing = sys.modules.get('multiprocessing')
+    if multiprocessing:
+        for child in multiprocessing.active_children():
+            os.kill(child.pid, signum)
+
+    # the snapshot is taken out of the event loop's thread
+    target = _take_baseline if signum == signal.SIGUSR1 else _compare_to_baseline
+    threading.Thread(target=target, daemon=True).start()
+
+
+if FRAMES:
+    tracemalloc.start(FRAMES)
+    signal.signal(signal.SIGUSR1, _on_signal)
+    signal.signal(signal.SIGUSR2, _on_signal)
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""
+Serves the Prometheus metrics of all the uvicorn workers.
+
+This script is pushed into the workload container & run by Pebble next to the
+FastAPI service when it has more than one worker. Each worker writes its metrics
+to PROMETHEUS_MULTIPROC_DIR, which are aggregated here on every scrape.
+
+The process metrics (memory & CPU) of the workers aren't written to that dir,
+so they're read from /proc & summed over the uvicorn processes instead.
+"""
+
+import os
+import re
+import sys
+import threading
+
+from prometheus_client import CollectorRegistry, start_http_server
+from prometheus_client import multiprocess
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+
+
+def process_stat(pid: int) -> tuple[int, float, int] | None:
+    """
+    Parent pid, CPU time (in seconds) & resident memory (in bytes) of a process,
+    None if it's gone
+    """
+    try:
+        with open(f'/proc/{pid}/stat') as file:
+            stat = file.read()
+    except OSError:
+        return None
+
+    # the fields after the command name, which may contain spaces & parentheses
+    fields = stat.rpartition(')')[2].split()
+    ppid, utime, stime, rss = int(fields[1]), int(fields[11]), int(fields[12]), int(fields[21])
+    return ppid, (utime + stime) / CLOCK_TICKS, rss * PAGE_SIZE
+
+
+class WorkersProcessCollector:
+    """
+    process_resident_memory_bytes & process_cpu_seconds_total of the uvicorn processes:
+    the workers writing their metrics to the multiprocess dir & their parent
+    """
+
+    def __init__(self, path: str) -> None:
+        self._path = path
+
+    def collect(self):
+        pids = {
+            int(match.group(1))
+            for match in map(re.compile(r'_(\d+)\.db$').search, os.listdir(self._path))
+            if match
+        }
+        stats = {pid: stat for pid in pids if (stat := process_stat(pid))}
+        # the main uvicorn process doesn't serve requests, so it doesn't write metrics
+        for ppid in {ppid for ppid, _, _ in stats.values()} - stats.keys():
+            if ppid > 1 and (stat := process_stat(ppid)):
+                stats[ppid] = stat
+
+        yield GaugeMetricFamily(
+            'process_resident_memory_bytes',
+            'Resident memory size in bytes, summed over the uvicorn processes.',
+            value=sum(rss for _, _, rss in stats.values()),
+        )
+        # a worker that's gone takes its CPU time with it, which rate() takes as a counter reset
+        yield CounterMetricFamily(
+            'process_cpu_seconds_total',
+            'Total user and system CPU time spent in seconds, summed over the uvicorn processes.',
+            value=sum(cpu for _, cpu, _ in stats.values()),
+        )
+
+
+if __name__ == "__main__":
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    registry.register(WorkersProcessCollector(os.environ['PROMETHEUS_MULTIPROC_DIR']))
+    start_http_server(int(sys.argv[1]), registry=registry)
+    threading.Event().wait()
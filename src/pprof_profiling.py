@@ -0,0 +1,221 @@
+"""
+Sampling CPU profiler of the workload processes, serving pprof profiles
+
+This module is pushed into the workload container & loaded by `sitecustomize`
+when the profiling-endpoint relation is set, on the start of the uvicorn process
+& of each of its workers. Every process samples the stacks of its threads
+DEMO_SERVER_PROFILING_SAMPLE_RATE times per second, keeping those of the threads
+that used the CPU since the previous sample, & writes the number of samples per
+stack so far to DEMO_SERVER_PROFILING_DIR/stacks-<pid>.json every second.
+
+The first process binding DEMO_SERVER_PROFILING_PORT (the main uvicorn process,
+which starts before its workers) serves GET /debug/pprof/profile?seconds=N: the
+stacks sampled by all the processes over the next N seconds, as a gzipped pprof
+protobuf, which is what the profiling backend (Parca) scrapes.
+"""
+
+import gzip
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+PORT = int(os.environ.get('DEMO_SERVER_PROFILING_PORT', '0'))
+SAMPLE_RATE = int(os.environ.get('DEMO_SERVER_PROFILING_SAMPLE_RATE', '100'))
+STACKS_DIR = os.environ.get('DEMO_SERVER_PROFILING_DIR', '/dev/shm/pprof-profiling')
+# seconds between the writes of the sampled stacks of a process
+FLUSH_INTERVAL = 1.0
+# frames kept per stack, from the innermost one
+MAX_DEPTH = 64
+# the default duration of a profile
+DEFAULT_SECONDS = 10
+
+# samples per stack, a stack being a tuple of (filename, function name, line) from the innermost frame
+_stacks = Counter()
+_lock = threading.Lock()
+_own_threads = set()
+# the CPU time of each thread at the previous sample
+_cpu_times = {}
+
+
+def _sample() -> None:
+    frames = sys._current_frames()
+    for ident in _cpu_times.keys() - frames.keys():
+        del _cpu_times[ident]
+    for ident, frame in frames.items():
+        if ident in _own_threads:
+            continue
+        try:
+            cpu_time = time.clock_gettime(time.pthread_getcpuclockid(ident))
+        except OSError:
+            # the thread is gone
+            continue
+        # a thread waiting (e.g. for I/O or a lock) isn't using the CPU
+        busy = cpu_time > _cpu_times.get(ident, cpu_time)
+        _cpu_times[ident] = cpu_time
+        if not busy:
+            continue
+        stack = []
+        while frame and len(stack) < MAX_DEPTH:
+            code = frame.f_code
+            stack.append((code.co_filename, getattr(code, 'co_qualname', code.co_name), frame.f_lineno))
+            frame = frame.f_back
+        with _lock:
+            _stacks[tuple(stack)] += 1
+
+
+def _flush() -> None:
+    with _lock:
+        stacks = [[stack, count] for stack, count in _stacks.items()]
+    path = os.path.join(STACKS_DIR, f'stacks-{os.getpid()}.json')
+    with open(f'{path}.tmp', 'w') as file:
+        json.dump(stacks, file)
+    os.replace(f'{path}.tmp', path)
+
+
+def _run_sampler() -> None:
+    _own_threads.add(threading.get_ident())
+    interval = 1 / SAMPLE_RATE
+    flushed = time.monotonic()
+    while True:
+        time.sleep(interval)
+        _sample()
+        if time.monotonic() - flushed >= FLUSH_INTERVAL:
+            _flush()
+            flushed = time.monotonic()
+
+
+def _read_stacks() -> Counter:
+    """
+    The samples per stack so far, summed over the processes. The files of the processes
+    that are gone are removed.
+    """
+    stacks = Counter()
+    for name in os.listdir(STACKS_DIR):
+        if not (name.startswith('stacks-') and name.endswith('.json')):
+            continue
+        path = os.path.join(STACKS_DIR, name)
+        try:
+            os.kill(int(name[len('stacks-'):-len('.json')]), 0)
+        except ProcessLookupError:
+            os.remove(path)
+            continue
+        with open(path) as file:
+            for stack, count in json.load(file):
+                stacks[tuple(map(tuple, stack))] += count
+    return stacks
+
+
+def _varint(value: int) -> bytes:
+    out = bytearray()
+    while value > 0x7f:
+        out.append(value & 0x7f | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def _int_field(number: int, value: int) -> bytes:
+    return _varint(number << 3) + _varint(value)
+
+
+def _bytes_field(number: int, value: bytes) -> bytes:
+    return _varint(number << 3 | 2) + _varint(len(value)) + value
+
+
+def encode_profile(stacks: Counter, started: float, duration: float, rate: int) -> bytes:
+    """
+    The gzipped pprof protobuf (see google/pprof's profile.proto) of the samples per stack
+    """
+    strings = {'': 0}
+    functions, locations = {}, {}
+
+    def string(value: str) -> int:
+        return strings.setdefault(value, len(strings))
+
+    def location(filename: str, name: str, line: int) -> int:
+        function = functions.setdefault((filename, name), len(functions) + 1)
+        return locations.setdefault((function, line), len(locations) + 1)
+
+    period = 1_000_000_000 // rate
+    value_types = [
+        _bytes_field(1, _int_field(1, string('samples')) + _int_field(2, string('count'))),
+        _bytes_field(1, _int_field(1, string('cpu')) + _int_field(2, string('nanoseconds'))),
+    ]
+    samples = []
+    for stack, count in stacks.items():
+        location_ids = b''.join(_varint(location(*frame)) for frame in stack)
+        values = _varint(count) + _varint(count * period)
+        samples.append(_bytes_field(2, _bytes_field(1, location_ids) + _bytes_field(2, values)))
+
+    profile = b''.join(value_types) + b''.join(samples)
+    for (function, line), location_id in locations.items():
+        line_info = _int_field(1, function) + _int_field(2, line)
+        profile += _bytes_field(4, _int_field(1, location_id) + _bytes_field(4, line_info))
+    for (filename, name), function_id in functions.items():
+        profile += _bytes_field(5, (
+            _int_field(1, function_id) + _int_field(2, string(name))
+            + _int_field(3, string(name)) + _int_field(4, string(filename))
+        ))
+    # the strings are all known once the functions are encoded
+    profile += b''.join(_bytes_field(6, value.encode()) for value in strings)
+    profile += _int_field(9, int(started * 1e9)) + _int_field(10, int(duration * 1e9))
+    profile += _bytes_field(11, _int_field(1, string('cpu')) + _int_field(2, string('nanoseconds')))
+    return gzip.compress(profile + _int_field(12, period))
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self) -> None:
+        url = urlparse(self.path)
+        if url.path != '/debug/pprof/profile':
+            self.send_error(404)
+            return
+        try:
+            seconds = float(parse_qs(url.query).get('seconds', [DEFAULT_SECONDS])[0])
+        except ValueError:
+            self.send_error(400, 'invalid seconds')
+            return
+
+        # the thread waiting for the samples isn't sampled itself
+        _own_threads.add(threading.get_ident())
+        try:
+            started = time.time()
+            before = _read_stacks()
+            # the samples of the last moments are written a flush later
+            time.sleep(seconds + FLUSH_INTERVAL)
+            stacks = _read_stacks()
+        finally:
+            _own_threads.discard(threading.get_ident())
+        stacks.subtract(before)
+        body = encode_profile(+stacks, started, seconds, SAMPLE_RATE)
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+
+def _serve(server: ThreadingHTTPServer) -> None:
+    _own_threads.add(threading.get_ident())
+    server.serve_forever()
+
+
+if PORT and SAMPLE_RATE > 0:
+    os.makedirs(STACKS_DIR, exist_ok=True)
+    threading.Thread(target=_run_sampler, name='pprof-sampler', daemon=True).start()
+    try:
+        _server = ThreadingHTTPServer(('0.0.0.0', PORT), _Handler)
+    except OSError:
+        # another process of the workload serves the profiles
+        _server = None
+    if _server:
+        _server.daemon_threads = True
+        threading.Thread(target=_serve, args=(_server,), name='pprof-server', daemon=True).start()
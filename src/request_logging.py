@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""
+Wraps the FastAPI demo app to log its requests.
+
+This module is pushed into the workload container & served by uvicorn in place of
+`api_demo_server.app:app` when the request logging is customised in the charm config.
+It replaces the uvicorn access log with one that is sampled, always logs the slow
+requests with their latency & route, and can be formatted as JSON.
+"""
+
+import json
+import logging
+import logging.handlers
+import os
+import random
+import time
+
+from api_demo_server.app import app as demo_app
+
+ACCESS_LOG_SAMPLE_RATE = float(os.environ.get('DEMO_SERVER_ACCESS_LOG_SAMPLE_RATE', '1'))
+SLOW_REQUEST_THRESHOLD = float(os.environ.get('DEMO_SERVER_SLOW_REQUEST_THRESHOLD', '0'))
+LOG_FORMAT = os.environ.get('DEMO_SERVER_LOG_FORMAT', 'text')
+
+logger = logging.getLogger('demo_server.access')
+
+
+class JSONFormatter(logging.Formatter):
+    """
+    Formats the log records as one JSON object per line
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        entry.update(getattr(record, 'request', {}))
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+
+def _setup_logging() -> None:
+    """
+    uvicorn has already configured its loggers when the app is imported,
+    so the handlers only need a formatter & a handler for the requests log.
+    A buffering handler doesn't format the records, its target does.
+    """
+    formatter = JSONFormatter() if LOG_FORMAT == 'json' else None
+
+    if not logging.getLogger().handlers:
+        logger.addHandler(logging.StreamHandler())
+        logger.propagate = False
+    logger.setLevel(logging.INFO)
+
+    if formatter:
+        for name in (None, 'uvicorn', 'uvicorn.error', 'uvicorn.access', logger.name):
+            for handler in logging.getLogger(name).handlers:
+                handler.setFormatter(formatter)
+                if isinstance(handler, logging.handlers.MemoryHandler) and handler.target:
+                    handler.target.setFormatter(formatter)
+
+
+async def app(scope, receive, send):
+    """
+    ASGI app timing the requests of the demo app
+    """
+    if scope['type'] != 'http':
+        await demo_app(scope, receive, send)
+        return
+
+    start = time.perf_counter()
+    status = 500
+
+    async def send_with_status(message):
+        nonlocal status
+        if message['type'] == 'http.response.start':
+            status = message['status']
+        await send(message)
+
+    try:
+        await demo_app(scope, receive, send_with_status)
+    finally:
+        latency = time.perf_counter() - start
+        slow = 0 < SLOW_REQUEST_THRESHOLD <= latency
+        if slow or random.random() < ACCESS_LOG_SAMPLE_RATE:
+            # the route is set on the scope by the router, the raw path is the fallback
+            route = getattr(scope.get('route'), 'path', scope['path'])
+            request = {
+                'method': scope['method'],
+                'route': route,
+                'status': status,
+                'latency': round(latency, 6),
+                'slow': slow,
+            }
+            logger.log(
+                logging.WARNING if slow else logging.INFO,
+                '%s %s %d %.3fs%s', scope['method'], route, status, latency, ' (slow)' if slow else '',
+                extra={'request': request},
+            )
+
+
+_setup_logging()
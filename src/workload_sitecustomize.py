@@ -0,0 +1,25 @@
+"""
+Loads the charm's modules into the workload processes
+
+This file is pushed into the workload container as `sitecustomize.py`, next to
+the modules it loads, & their dir is prepended to the PYTHONPATH of the workload,
+so that Python imports it on the start of the uvicorn process & of each of its
+workers. It imports the modules listed in DEMO_SERVER_SITE_MODULES, then the
+`sitecustomize` it shadows further down the path (e.g. that of the distro), if any.
+"""
+
+import importlib
+import importlib.machinery
+import importlib.util
+import os
+import sys
+
+_DIR = os.path.dirname(os.path.abspath(__file__))
+
+for _name in filter(None, os.environ.get('DEMO_SERVER_SITE_MODULES', '').split(',')):
+    importlib.import_module(_name)
+
+_path = [path for path in sys.path if os.path.abspath(path or os.curdir) != _DIR]
+_spec = importlib.machinery.PathFinder.find_spec('sitecustomize', _path)
+if _spec and _spec.loader:
+    _spec.loader.exec_module(importlib.util.module_from_spec(_spec))
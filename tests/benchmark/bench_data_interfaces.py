@@ -0,0 +1,332 @@
+#!/usr/bin/env python3
+"""
+Scale benchmark of the data_interfaces library
+
+Runs the relation classes of the library (database, Kafka, OpenSearch & Etcd,
+both sides, & `DataPeer`) with a growing number of relations & secret groups,
+on the `ops.testing` model backend with an injected latency on every hook tool
+call, the way a hook tool is a subprocess on a real unit. For each of them it
+reports the median time & the number of hook tool calls of:
+
+- fetch_relation_data: all the relations (`fetch_my_relation_data` for `DataPeer`,
+  which only reads its own side)
+- update_relation_data: one relation, the requirer updates its request, the provider
+  rotates its credentials & the peer its fields
+- is_resource_created: all the relations (requirer side only)
+- relation-changed: the dispatch of the library's relation-changed handlers on one relation
+
+The secret groups are user, tls & extra for the client relations, which are the
+groups of the library the provider shares with the requirer. `DataPeer` also
+gets custom groups, up to 5. For `DataPeer` the relation count is the number of
+peer units, as there's a single peer relation.
+
+    tox -e benchmark-data-interfaces
+    tox -e benchmark-data-interfaces -- --case database-requires --relations 1000 --latency 0.002
+"""
+
+import argparse
+import dataclasses
+import json
+import logging
+import platform
+import statistics
+import sys
+import time
+from typing import Callable
+
+import ops
+from ops import testing
+
+from charms.data_platform_libs.v0.data_interfaces import (
+    DatabaseProvides,
+    DatabaseRequires,
+    DataPeer,
+    EtcdProvides,
+    EtcdRequires,
+    KafkaProvides,
+    KafkaRequires,
+    OpenSearchProvides,
+    OpenSearchRequires,
+)
+from hook_tool_stats import timed_calls
+
+# the model backend methods running a hook tool
+HOOK_TOOL_METHODS = (
+    'relation_ids', 'relation_list', 'relation_remote_app_name', 'relation_get', 'relation_set',
+    'config_get', 'is_leader', 'secret_get', 'secret_info_get', 'secret_set', 'secret_add',
+    'secret_grant', 'secret_revoke', 'secret_remove',
+)
+
+# the fields shared in each secret group of the client relations, or in plain text without it
+CLIENT_GROUPS = {
+    'user': {'username': 'bench-user', 'password': 'bench-password'},
+    'tls': {'tls': 'True', 'tls-ca': '-----BEGIN CERTIFICATE-----'},
+    'extra': {'extra-secret': 'bench-extra'},
+}
+PEER_GROUPS = 5
+
+class SlowBackend:
+    """
+    Adds a fixed latency to every hook tool call of a model backend & counts the calls
+    """
+
+    def __init__(self, backend, latency: float) -> None:
+        self.calls = 0
+        self.latency = latency
+        for method_name, wrapper in timed_calls(backend, HOOK_TOOL_METHODS, self._record).items():
+            setattr(backend, method_name, wrapper)
+
+    def _record(self, method_name: str, seconds: float) -> None:
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+class BenchCharm(ops.CharmBase):
+    """
+    A charm with nothing but the library object of a case, set by `Case.charm_type`
+    """
+
+    factory: Callable[[ops.CharmBase], object]
+
+    def __init__(self, framework: ops.Framework) -> None:
+        super().__init__(framework)
+        self.lib = self.factory()
+
+@dataclasses.dataclass
+class Case:
+    """
+    One class of the library, with its side of the relation & the request of the requirer
+    """
+    factory: Callable[[ops.CharmBase, int], object]
+    role: str
+    interface: str
+    resource_field: str = 'database'
+
+    @property
+    def endpoint(self) -> str:
+        return 'bench-peers' if self.role == 'peers' else 'bench'
+
+    def charm_type(self, groups: int) -> type[BenchCharm]:
+        factory = self.factory
+        return type('BenchCharm', (BenchCharm,), {'factory': lambda charm: factory(charm, groups)})
+
+    def meta(self) -> dict:
+        return {'name': 'bench', self.role: {self.endpoint: {'interface': self.interface}}}
+
+    def groups(self, groups: int) -> dict[str, dict[str, str]]:
+        """
+        The fields of each of the first `groups` secret groups
+        """
+        if self.role == 'peers':
+            return {f'group{index}': {f'field{index}': 'bench-value'} for index in range(groups)}
+        return dict(list(CLIENT_GROUPS.items())[:groups])
+
+    def max_groups(self) -> int:
+        return PEER_GROUPS if self.role == 'peers' else len(CLIENT_GROUPS)
+
+    def update(self, groups: int) -> dict[str, str]:
+        """
+        The data written by `update_relation_data`
+        """
+        if self.role == 'requires':
+            return {'extra-user-roles': 'admin'}
+        if self.role == 'peers':
+            return {f'field{index}': 'rotated' for index in range(PEER_GROUPS)}
+        return {'username': 'bench-user', 'password': 'rotated'}
+
+    def relations(self, count: int, groups: int) -> tuple[set, set]:
+        """
+        The relations & secrets of the state, before anything is published
+        """
+        resource = {self.resource_field: 'bench'}
+        secret_fields = [field for fields in self.groups(groups).values() for field in fields]
+
+        if self.role == 'peers':
+            relation = testing.PeerRelation(
+                endpoint=self.endpoint, interface=self.interface,
+                peers_data={index: {} for index in range(1, count + 1)},
+            )
+            return {relation}, set()
+
+        if self.role == 'provides':
+            # the request of the requirer app, waiting for its credentials
+            return {
+                testing.Relation(
+                    endpoint=self.endpoint, interface=self.interface, remote_app_name=f'requirer{index}',
+                    remote_app_data={**resource, 'requested-secrets': json.dumps(secret_fields)},
+                )
+                for index in range(count)
+            }, set()
+
+        # the request of this app & the credentials shared by the provider
+        relations, secrets = set(), set()
+        for index in range(count):
+            remote_app_data = {**resource, 'endpoints': f'provider{index}.example.com:5432'}
+            for group, fields in CLIENT_GROUPS.items():
+                if group in self.groups(groups):
+                    secret = testing.Secret(tracked_content=fields)
+                    remote_app_data[f'secret-{group}'] = secret.id
+                    secrets.add(secret)
+                else:
+                    remote_app_data.update(fields)
+            relations.add(testing.Relation(
+                endpoint=self.endpoint, interface=self.interface, remote_app_name=f'provider{index}',
+                local_app_data={**resource, 'requested-secrets': json.dumps(secret_fields)},
+                remote_app_data=remote_app_data,
+            ))
+
+        return relations, secrets
+
+    def publish(self, lib, relation_ids: list[int], groups: int) -> None:
+        """
+        What the provider & the peer have published by the time the data is fetched
+        """
+        if self.role == 'provides':
+            fields = {field: value for fields in CLIENT_GROUPS.values() for field, value in fields.items()}
+            for relation_id in relation_ids:
+                lib.update_relation_data(relation_id, fields)
+        elif self.role == 'peers':
+            fields = {f'field{index}': 'bench-value' for index in range(PEER_GROUPS)}
+            lib.update_relation_data(relation_ids[0], fields)
+
+def _peer(charm, groups):
+    mapping = {f'group{index}': [f'field{index}'] for index in range(groups)}
+    return DataPeer(
+        charm, 'bench-peers',
+        additional_secret_fields=[field for fields in mapping.values() for field in fields],
+        additional_secret_group_mapping=mapping,
+    )
+
+CASES = {
+    'database-requires': Case(
+        lambda charm, _: DatabaseRequires(charm, 'bench', 'bench', additional_secret_fields=['extra-secret']),
+        'requires', 'postgresql_client',
+    ),
+    'database-provides': Case(lambda charm, _: DatabaseProvides(charm, 'bench'), 'provides', 'postgresql_client'),
+    'kafka-requires': Case(
+        lambda charm, _: KafkaRequires(charm, 'bench', 'bench', additional_secret_fields=['extra-secret']),
+        'requires', 'kafka_client', 'topic',
+    ),
+    'kafka-provides': Case(lambda charm, _: KafkaProvides(charm, 'bench'), 'provides', 'kafka_client', 'topic'),
+    'opensearch-requires': Case(
+        lambda charm, _: OpenSearchRequires(charm, 'bench', 'bench', additional_secret_fields=['extra-secret']),
+        'requires', 'opensearch_client', 'index',
+    ),
+    'opensearch-provides': Case(
+        lambda charm, _: OpenSearchProvides(charm, 'bench'), 'provides', 'opensearch_client', 'index',
+    ),
+    'etcd-requires': Case(
+        lambda charm, _: EtcdRequires(charm, 'bench', 'bench', None, additional_secret_fields=['extra-secret']),
+        'requires', 'etcd_client', 'prefix',
+    ),
+    'etcd-provides': Case(lambda charm, _: EtcdProvides(charm, 'bench'), 'provides', 'etcd_client', 'prefix'),
+    'data-peer': Case(_peer, 'peers', 'bench_peers'),
+}
+
+def setup(case: Case, ctx: testing.Context, count: int, groups: int) -> testing.State:
+    """
+    The state of a leader unit with `count` relations, once the data is published
+    """
+    relations, secrets = case.relations(count, groups)
+    state = testing.State(relations=relations, secrets=secrets, leader=True)
+    with ctx(ctx.on.update_status(), state) as manager:
+        case.publish(manager.charm.lib, sorted(relation.id for relation in relations), groups)
+        return manager.run()
+
+def measure(case: Case, count: int, groups: int, latency: float, iterations: int) -> dict[str, dict]:
+    """
+    Median time (in milliseconds) & hook tool calls of each operation
+    """
+    ctx = testing.Context(case.charm_type(groups), meta=case.meta())
+    state = setup(case, ctx, count, groups)
+    relation = min(state.relations, key=lambda relation: relation.id)
+
+    operations = {
+        'fetch_relation_data': (
+            lambda lib: lib.fetch_my_relation_data() if case.role == 'peers' else lib.fetch_relation_data()
+        ),
+        'update_relation_data': lambda lib: lib.update_relation_data(relation.id, case.update(groups)),
+    }
+    if case.role == 'requires':
+        operations['is_resource_created'] = lambda lib: lib.is_resource_created()
+
+    results = {}
+    for name, operation in operations.items():
+        samples = []
+        for _ in range(iterations):
+            with ctx(ctx.on.update_status(), state) as manager:
+                backend = SlowBackend(manager.charm.model._backend, latency)
+                start = time.perf_counter()
+                operation(manager.charm.lib)
+                samples.append((time.perf_counter() - start, backend.calls))
+                manager.run()
+        results[name] = summarise(samples)
+
+    samples = []
+    remote_unit = 1 if case.role == 'peers' else 0
+    for _ in range(iterations):
+        with ctx(ctx.on.relation_changed(relation, remote_unit=remote_unit), state) as manager:
+            backend = SlowBackend(manager.charm.model._backend, latency)
+            start = time.perf_counter()
+            manager.run()
+            samples.append((time.perf_counter() - start, backend.calls))
+    results['relation-changed'] = summarise(samples)
+
+    return results
+
+def summarise(samples: list[tuple[float, int]]) -> dict:
+    return {
+        'median_ms': round(statistics.median(duration for duration, _ in samples) * 1000, 3),
+        'hook_tool_calls': max(calls for _, calls in samples),
+    }
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--case', action='append', choices=CASES, help='library classes to run (default: all)')
+    parser.add_argument(
+        '--relations', type=int, action='append', help='relation counts (default: 1, 10, 100 & 1000)',
+    )
+    parser.add_argument(
+        '--secret-groups', type=int, action='append',
+        help='secret groups per relation (default: 0 up to all the groups of the class)',
+    )
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every hook tool call')
+    parser.add_argument('--iterations', type=int, default=3, help='runs of each operation')
+    parser.add_argument('--output', help='write the JSON results to this file instead of stdout')
+    args = parser.parse_args()
+
+    # the library logs every secret & relation access
+    logging.disable(logging.CRITICAL)
+
+    results = {
+        'python': platform.python_version(),
+        'latency': args.latency,
+        'iterations': args.iterations,
+        'results': {},
+    }
+    for name in args.case or CASES:
+        case = CASES[name]
+        for count in args.relations or [1, 10, 100, 1000]:
+            for groups in args.secret_groups or range(case.max_groups() + 1):
+                if groups > case.max_groups():
+                    continue
+                stats = measure(case, count, groups, args.latency, args.iterations)
+                results['results'].setdefault(name, {}).setdefault(str(count), {})[str(groups)] = stats
+                print(
+                    f'{name} relations={count} secret-groups={groups}: ' + ', '.join(
+                        f"{operation} {stat['median_ms']}ms/{stat['hook_tool_calls']} calls"
+                        for operation, stat in stats.items()
+                    ),
+                    file=sys.stderr,
+                )
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(output + '\n')
+    else:
+        print(output)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+"""
+Hook latency micro-benchmark
+
+Runs every event of `FastAPIDemoCharm` on every scenario of `scenarios.py` with
+`ops.testing`, without a Juju controller, & reports the latency distribution
+of each pair as JSON. The results can be saved as a baseline & later runs
+compared against it:
+
+    tox -e benchmark -- --save-baseline baseline.json
+    tox -e benchmark -- --baseline baseline.json
+"""
+
+import argparse
+import json
+import logging
+import math
+import platform
+import statistics
+import sys
+import time
+
+from ops import testing
+
+from charm import FastAPIDemoCharm
+from scenarios import EVENTS, SCENARIOS, Run
+
+def percentile(ordered: list[float], quantile: float) -> float:
+    """
+    Nearest-rank percentile of a sorted list
+    """
+    return ordered[max(math.ceil(quantile * len(ordered)) - 1, 0)]
+
+def measure(run: Run, iterations: int, warmup: int) -> dict[str, float] | None:
+    """
+    Latency distribution (in milliseconds) of `iterations` runs of the event.
+    Only the dispatch is timed, not the building of its state.
+    """
+    ctx = testing.Context(FastAPIDemoCharm)
+    for _ in range(warmup):
+        if run(ctx) is None:
+            return None
+
+    durations = []
+    for _ in range(iterations):
+        event, state = run.prepare(ctx)
+        start = time.perf_counter()
+        run.execute(ctx, event, state)
+        durations.append((time.perf_counter() - start) * 1000)
+
+    durations.sort()
+    return {
+        'count': len(durations),
+        'mean': round(statistics.fmean(durations), 4),
+        'p50': round(percentile(durations, 0.50), 4),
+        'p95': round(percentile(durations, 0.95), 4),
+        'p99': round(percentile(durations, 0.99), 4),
+        'max': round(durations[-1], 4),
+    }
+
+def compare(results: dict, baseline: dict, threshold: float) -> list[str]:
+    """
+    The scenario/event pairs whose p50 is more than `threshold` percent above the baseline
+    """
+    regressions = []
+    for scenario, events in results['results'].items():
+        for event, stats in events.items():
+            base = baseline['results'].get(scenario, {}).get(event)
+            if not base:
+                continue
+            change = (stats['p50'] - base['p50']) / base['p50'] * 100
+            stats['p50_change_percent'] = round(change, 2)
+            if change > threshold:
+                regressions.append(
+                    f"{scenario}/{event}: p50 {base['p50']}ms -> {stats['p50']}ms (+{change:.1f}%)"
+                )
+
+    return regressions
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--iterations', type=int, default=1000, help='runs of each event per scenario')
+    parser.add_argument('--warmup', type=int, default=20, help='runs before the measured ones')
+    parser.add_argument('--scenario', action='append', choices=SCENARIOS, help='scenarios to run (default: all)')
+    parser.add_argument('--event', action='append', choices=EVENTS, help='events to run (default: all)')
+    parser.add_argument('--output', help='write the JSON results to this file instead of stdout')
+    parser.add_argument('--save-baseline', help='also write the JSON results to this baseline file')
+    parser.add_argument('--baseline', help='compare the results with this baseline file')
+    parser.add_argument('--threshold', type=float, default=10.0, help='p50 regression in percent that fails the run')
+    args = parser.parse_args()
+
+    # the charm & scenario logs would dominate the output
+    logging.disable(logging.CRITICAL)
+
+    results = {
+        'python': platform.python_version(),
+        'iterations': args.iterations,
+        'results': {},
+    }
+    for scenario in args.scenario or SCENARIOS:
+        for event in args.event or EVENTS:
+            stats = measure(Run(scenario, event), args.iterations, args.warmup)
+            if stats:
+                results['results'].setdefault(scenario, {})[event] = stats
+                print(f"{scenario}/{event}: p50 {stats['p50']}ms p95 {stats['p95']}ms", file=sys.stderr)
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as baseline:
+            regressions = compare(results, json.load(baseline), args.threshold)
+        results['regressions'] = regressions
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(output + '\n')
+    else:
+        print(output)
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as file:
+            file.write(output + '\n')
+
+    for regression in regressions:
+        print(f'regression: {regression}', file=sys.stderr)
+    return 1 if regressions else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+"""
+Import-time benchmark of the charm's dispatches
+
+Every dispatch is a fresh Python process, which imports the charm module (ops,
+data_interfaces, ...) & then whatever the observers of the event import lazily.
+Each scenario/event pair is run in a child process under `python -X importtime`
+& the import time is broken down by module, in two parts:
+
+- charm: the imports of the charm module itself, paid on every dispatch
+- event: the imports made while the event runs (e.g. the observability libraries)
+
+The import time of `ops.testing` & of the benchmark itself is left out.
+
+    tox -e benchmark-imports
+    tox -e benchmark-imports -- --scenario observability --event config-changed
+"""
+
+# only `sys` is imported up front: the modules imported before the charm in the
+# child process wouldn't show up in its import log
+import sys
+
+# written to stderr by the child process between the parts of the import log
+MARKER = 'bench-imports:'
+
+def child(scenario: str, event: str) -> None:
+    """
+    Import the charm & run one event, marking the parts of the import log
+    """
+    print(f'{MARKER}charm', file=sys.stderr, flush=True)
+    import charm
+
+    print(f'{MARKER}harness', file=sys.stderr, flush=True)
+    import logging
+    from ops import testing
+    from scenarios import Run
+
+    logging.disable(logging.CRITICAL)
+    ctx = testing.Context(charm.FastAPIDemoCharm)
+    # the harness imports part of itself on the first run, without any observability relation
+    Run('no-relation', 'update-status')(ctx)
+
+    print(f'{MARKER}event', file=sys.stderr, flush=True)
+    Run(scenario, event)(ctx)
+    print(f'{MARKER}end', file=sys.stderr, flush=True)
+
+def parse(log: str) -> dict[str, dict[str, int]]:
+    """
+    Self import time (in microseconds) of each module, by part of the import log
+    """
+    from collections import defaultdict
+
+    parts = defaultdict(dict)
+    part = None
+    for line in log.splitlines():
+        if line.startswith(MARKER):
+            part = line[len(MARKER):]
+        elif line.startswith('import time:') and part in ('charm', 'event'):
+            self_us, _, name = line[len('import time:'):].split('|')
+            if self_us.strip().isdigit():
+                parts[part][name.strip()] = int(self_us)
+
+    return parts
+
+def group(module: str, depth: int) -> str:
+    """
+    The package a module is accounted to, the charm libraries (charms.<charm>.<api>.<lib>)
+    are grouped by charm at depth 1 & by library from depth 2
+    """
+    parts = module.split('.')
+    if parts[0] == 'charms':
+        depth += 2 if depth > 1 else 1
+    return '.'.join(parts[:depth])
+
+def measure(scenario: str, event: str, runs: int, depth: int) -> dict | None:
+    """
+    Median import time (in milliseconds) of each part & of its packages, over `runs` processes
+    """
+    import os
+    import statistics
+    import subprocess
+    from collections import defaultdict
+
+    samples = defaultdict(lambda: defaultdict(list))
+    for _ in range(runs):
+        process = subprocess.run(
+            [sys.executable, '-X', 'importtime', __file__, '--child', scenario, event],
+            capture_output=True, text=True, env=os.environ,
+        )
+        if process.returncode:
+            print(process.stderr, file=sys.stderr)
+            return None
+        for part, modules in parse(process.stderr).items():
+            packages = defaultdict(int)
+            for module, self_us in modules.items():
+                packages[group(module, depth)] += self_us
+            samples[part]['total'].append(sum(modules.values()))
+            for package, self_us in packages.items():
+                samples[part][package].append(self_us)
+
+    results = {}
+    for part in ('charm', 'event'):
+        # a package imported in only some of the runs counts as 0 in the others
+        medians = {
+            key: round(statistics.median(values + [0] * (runs - len(values))) / 1000, 3)
+            for key, values in samples[part].items()
+        }
+        total = medians.pop('total', 0)
+        results[part] = {
+            'total': total,
+            'packages': dict(sorted(medians.items(), key=lambda item: -item[1])),
+        }
+
+    return results
+
+def main() -> int:
+    import argparse
+    import json
+    import platform
+
+    from scenarios import EVENTS, SCENARIOS
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5, help='processes per scenario/event')
+    parser.add_argument('--depth', type=int, default=1, help='depth of the package names to group the modules by')
+    parser.add_argument('--top', type=int, default=10, help='packages reported per part')
+    parser.add_argument('--scenario', action='append', choices=SCENARIOS, help='scenarios to run (default: all)')
+    parser.add_argument('--event', action='append', choices=EVENTS, help='events to run (default: all)')
+    parser.add_argument('--output', help='write the JSON results to this file instead of stdout')
+    args = parser.parse_args()
+
+    results = {
+        'python': platform.python_version(),
+        'runs': args.runs,
+        'results': {},
+    }
+    for scenario in args.scenario or SCENARIOS:
+        for event in args.event or EVENTS:
+            stats = measure(scenario, event, args.runs, args.depth)
+            if not stats:
+                continue
+            for part in stats.values():
+                part['packages'] = dict(list(part['packages'].items())[:args.top])
+            results['results'].setdefault(scenario, {})[event] = stats
+            print(
+                f"{scenario}/{event}: charm {stats['charm']['total']}ms event {stats['event']['total']}ms",
+                file=sys.stderr,
+            )
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(output + '\n')
+    else:
+        print(output)
+    return 0
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--child']:
+        child(*sys.argv[2:4])
+        sys.exit(0)
+    sys.exit(main())
@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+"""
+Memory benchmark of the charm's dispatches
+
+Each scenario/event pair is run in a child process, like a dispatch, after a
+warm-up run paying for the imports & the first-run caches, once under
+`tracemalloc` & once to measure the RSS:
+
+- traced_peak_bytes: the peak of the memory allocated by Python during the event
+- modules: the bytes allocated during the event & still alive at its sampled peak,
+  by module. The traced memory is sampled after every hook tool call (where
+  data_interfaces builds the JSON copies of the databags & secrets) & at the end
+  of the dispatch, the largest sample is broken down.
+- rss_delta_kib: the RSS after the event minus the RSS before it (from
+  /proc/self/statm), i.e. what the allocator kept from the OS, which may be
+  negative. The traced memory is the more precise metric of the event.
+- rss_peak_kib: the peak RSS of the process
+
+    tox -e benchmark-memory
+    tox -e benchmark-memory -- --scenario huge-databag-all-groups --event database-relation-changed
+"""
+
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tracemalloc
+
+from ops import testing
+
+from bench_imports import group
+from conftest import drop_aliased_events
+from scenarios import EVENTS, SCENARIOS
+
+# the allocations of the testing harness & of the benchmark itself aren't reported
+HARNESS_MODULES = {'scenario', 'scenarios', 'bench_memory', 'tracemalloc'}
+
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+class PeakSampler:
+    """
+    Keeps the snapshot of the largest traced memory seen so far
+    """
+
+    def __init__(self, frames: int) -> None:
+        self.frames = frames
+        self.size = 0
+        self.snapshot = None
+        self.baseline = None
+
+    def start(self) -> None:
+        tracemalloc.start(self.frames)
+        self.baseline = tracemalloc.take_snapshot()
+        tracemalloc.reset_peak()
+
+    def sample(self) -> None:
+        size, _ = tracemalloc.get_traced_memory()
+        if size > self.size:
+            self.size = size
+            self.snapshot = tracemalloc.take_snapshot()
+
+    def wrap(self, backend) -> None:
+        """
+        Sample after every hook tool call of the backend, see `HookToolStats`
+        """
+        from hook_tool_stats import HOOK_TOOLS, timed_calls
+
+        for method_name, wrapper in timed_calls(backend, HOOK_TOOLS, lambda *_: self.sample()).items():
+            setattr(backend, method_name, wrapper)
+
+def module_name(filename: str) -> str:
+    """
+    Dotted name of the module of a source file, from the longest matching `sys.path` entry
+    """
+    roots = [path for path in sys.path if path and filename.startswith(os.path.join(path, ''))]
+    if not roots:
+        return filename
+    relative = os.path.relpath(filename, max(roots, key=len))
+    return relative.removesuffix('.py').removesuffix('/__init__').replace(os.sep, '.')
+
+def rss_kib() -> int:
+    """
+    The current RSS of the process, the second field of /proc/self/statm in pages
+    """
+    with open('/proc/self/statm') as file:
+        return int(file.read().split()[1]) * PAGE_SIZE // 1024
+
+def run_event(scenario: str, event: str, sampler: PeakSampler | None = None) -> bool:
+    """
+    Run the event on a fresh state of the scenario, False if it doesn't apply.
+    The state is built before the sampler starts tracing.
+    """
+    from charm import FastAPIDemoCharm
+
+    ctx = testing.Context(FastAPIDemoCharm)
+    state = SCENARIOS[scenario]()
+    event_ = EVENTS[event](ctx, state)
+    if event_ is None:
+        return False
+
+    drop_aliased_events()
+    if sampler:
+        sampler.start()
+    with ctx(event_, state) as manager:
+        if sampler:
+            sampler.wrap(manager.charm.model._backend)
+        try:
+            manager.run()
+        except testing.ActionFailed:
+            pass
+        if sampler:
+            sampler.sample()
+
+    return True
+
+def child(scenario: str, event: str, frames: int, depth: int, top: int) -> dict | None:
+    """
+    Measure the traced memory, then the RSS, of one event
+    """
+    import logging
+    logging.disable(logging.CRITICAL)
+
+    # the imports & the first-run caches are paid before the measured runs
+    if not run_event(scenario, event):
+        return None
+
+    sampler = PeakSampler(frames)
+    run_event(scenario, event, sampler)
+    _, traced_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    rss_before = rss_kib()
+    run_event(scenario, event)
+    rss_delta = rss_kib() - rss_before
+
+    modules = {}
+    if sampler.snapshot:
+        for stat in sampler.snapshot.compare_to(sampler.baseline, 'filename'):
+            name = group(module_name(stat.traceback[0].filename), depth)
+            if stat.size_diff <= 0 or name.split('.')[0] in HARNESS_MODULES:
+                continue
+            modules[name] = modules.get(name, 0) + stat.size_diff
+
+    return {
+        'traced_peak_bytes': traced_peak,
+        'sampled_peak_bytes': sampler.size,
+        'modules': dict(sorted(modules.items(), key=lambda item: -item[1])[:top]),
+        'rss_delta_kib': rss_delta,
+        # ru_maxrss is in KiB on Linux
+        'rss_peak_kib': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--child', nargs=2, metavar=('SCENARIO', 'EVENT'), help=argparse.SUPPRESS)
+    parser.add_argument('--frames', type=int, default=1, help='frames kept per traced allocation')
+    parser.add_argument('--depth', type=int, default=2, help='depth of the module names to group the allocations by')
+    parser.add_argument('--top', type=int, default=10, help='modules reported per event')
+    parser.add_argument('--scenario', action='append', choices=SCENARIOS, help='scenarios to run (default: all)')
+    parser.add_argument('--event', action='append', choices=EVENTS, help='events to run (default: all)')
+    parser.add_argument('--output', help='write the JSON results to this file instead of stdout')
+    args = parser.parse_args()
+
+    options = ['--frames', str(args.frames), '--depth', str(args.depth), '--top', str(args.top)]
+    if args.child:
+        print(json.dumps(child(*args.child, args.frames, args.depth, args.top)))
+        return 0
+
+    results = {
+        'python': platform.python_version(),
+        'results': {},
+    }
+    for scenario in args.scenario or SCENARIOS:
+        for event in args.event or EVENTS:
+            process = subprocess.run(
+                [sys.executable, __file__, '--child', scenario, event, *options],
+                capture_output=True, text=True,
+            )
+            if process.returncode:
+                print(process.stderr, file=sys.stderr)
+                return 1
+            stats = json.loads(process.stdout)
+            if not stats:
+                continue
+            results['results'].setdefault(scenario, {})[event] = stats
+            print(
+                f"{scenario}/{event}: traced peak {stats['traced_peak_bytes'] / 1024:.1f}KiB "
+                f"rss {stats['rss_delta_kib']:+}KiB",
+                file=sys.stderr,
+            )
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(output + '\n')
+    else:
+        print(output)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
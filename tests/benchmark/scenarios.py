@@ -0,0 +1,154 @@
+"""
+Charm states & events shared by the benchmarks.
+
+Each scenario is a `testing.State` with a different shape of database relation data
+& secrets, each event a function building the `ctx.on` event to run on that state.
+"""
+
+import dataclasses
+
+from ops import testing
+
+from conftest import drop_aliased_events
+
+def database_relation(
+    index: int = 0,
+    secret_groups: tuple[str, ...] = (),
+    extra_keys: int = 0,
+    alias: str | None = None,
+) -> tuple[testing.Relation, list[testing.Secret]]:
+    """
+    A database relation to a postgresql app, with its credentials shared in plain
+    text or in secrets (one per secret group: 'user', 'tls', 'extra').
+    `extra_keys` adds unrelated fields to the remote databag, making it bigger.
+    """
+    remote_app_data = {'endpoints': f'postgresql-{index}.example.com:5432'}
+    secrets = []
+
+    if 'user' in secret_groups:
+        secret = testing.Secret(tracked_content={'username': f'user{index}', 'password': 'secret'})
+        remote_app_data['secret-user'] = secret.id
+        secrets.append(secret)
+    else:
+        remote_app_data.update({'username': f'user{index}', 'password': 'secret'})
+
+    if 'tls' in secret_groups:
+        secret = testing.Secret(tracked_content={'tls': 'true', 'tls-ca': '-----BEGIN CERTIFICATE-----'})
+        remote_app_data['secret-tls'] = secret.id
+        secrets.append(secret)
+
+    if 'extra' in secret_groups:
+        secret = testing.Secret(tracked_content={'uris': f'postgresql://postgresql-{index}.example.com:5432'})
+        remote_app_data['secret-extra'] = secret.id
+        secrets.append(secret)
+
+    remote_app_data.update({f'extra-field-{key}': 'x' * 64 for key in range(extra_keys)})
+
+    relation = testing.Relation(
+        endpoint='database',
+        interface='postgresql_client',
+        remote_app_name=f'postgresql-k8s-{index}',
+        local_unit_data={'alias': alias} if alias else {},
+        remote_app_data=remote_app_data,
+    )
+
+    return relation, secrets
+
+def build_state(relations: list[tuple[testing.Relation, list[testing.Secret]]], **kwargs) -> testing.State:
+    """
+    A leader unit with the workload container reachable & the given database relations
+    """
+    return testing.State(
+        containers={testing.Container(name='demo-server', can_connect=True)},
+        relations={relation for relation, _ in relations},
+        secrets={secret for _, secrets in relations for secret in secrets},
+        leader=True,
+        **kwargs,
+    )
+
+def observability_relations() -> list[tuple[testing.Relation, list[testing.Secret]]]:
+    """
+    A relation on every observability endpoint, so that their libraries are set up
+    """
+    return [
+        (testing.Relation(endpoint=endpoint, interface=interface), [])
+        for endpoint, interface in {
+            'metrics-endpoint': 'prometheus_scrape',
+            'log-proxy': 'loki_push_api',
+            'grafana-dashboard': 'grafana_dashboard',
+            'tracing': 'tracing',
+            'profiling-endpoint': 'parca_scrape',
+        }.items()
+    ]
+
+SCENARIOS = {
+    'no-relation': lambda: build_state([]),
+    'plain': lambda: build_state([database_relation()]),
+    'secret-user': lambda: build_state([database_relation(secret_groups=('user',))]),
+    'secret-all-groups': lambda: build_state([database_relation(secret_groups=('user', 'tls', 'extra'))]),
+    'large-databag': lambda: build_state([database_relation(secret_groups=('user',), extra_keys=500)]),
+    'shards': lambda: build_state([
+        database_relation(index, secret_groups=('user',), alias=f'shard{index}') for index in range(4)
+    ]),
+    'huge-databag-all-groups': lambda: build_state([
+        database_relation(secret_groups=('user', 'tls', 'extra'), extra_keys=5000)
+    ]),
+    'shards-all-groups': lambda: build_state([
+        database_relation(index, secret_groups=('user', 'tls', 'extra'), alias=f'shard{index}')
+        for index in range(4)
+    ]),
+    'observability': lambda: build_state([database_relation(), *observability_relations()]),
+}
+
+def _database_relation(state: testing.State) -> testing.Relation | None:
+    return next((relation for relation in state.relations if relation.endpoint == 'database'), None)
+
+def _relation_changed(ctx: testing.Context, state: testing.State):
+    relation = _database_relation(state)
+    return ctx.on.relation_changed(relation, remote_unit=0) if relation else None
+
+EVENTS = {
+    'pebble-ready': lambda ctx, state: ctx.on.pebble_ready(state.get_container('demo-server')),
+    'config-changed': lambda ctx, state: ctx.on.config_changed(),
+    'update-status': lambda ctx, state: ctx.on.update_status(),
+    'leader-elected': lambda ctx, state: ctx.on.leader_elected(),
+    'database-relation-changed': _relation_changed,
+    'collect-status': lambda ctx, state: ctx.on.collect_unit_status(),
+    'get-db-info': lambda ctx, state: ctx.on.action('get-db-info', params={'show-password': True}),
+    'perf-report': lambda ctx, state: ctx.on.action('perf-report'),
+}
+
+@dataclasses.dataclass
+class Run:
+    """
+    One event to run on one scenario
+    """
+    scenario: str
+    event: str
+
+    def __call__(self, ctx: testing.Context) -> testing.State | None:
+        """
+        Run the event on a fresh state of the scenario, None if it doesn't apply
+        """
+        prepared = self.prepare(ctx)
+        return self.execute(ctx, *prepared) if prepared else None
+
+    def prepare(self, ctx: testing.Context) -> tuple | None:
+        """
+        The event & a fresh state of the scenario to run it on, None if it doesn't apply
+        """
+        state = SCENARIOS[self.scenario]()
+        event = EVENTS[self.event](ctx, state)
+        if event is None:
+            return None
+        drop_aliased_events()
+        return event, state
+
+    def execute(self, ctx: testing.Context, event, state: testing.State) -> testing.State:
+        """
+        Run a prepared event. A failed action (e.g. get-db-info without a database) is still a run.
+        """
+        try:
+            return ctx.run(event, state)
+        except testing.ActionFailed as e:
+            return e.state
@@ -0,0 +1,17 @@
+import pytest
+
+from charms.data_platform_libs.v0.data_interfaces import DatabaseRequiresEvents
+
+def drop_aliased_events():
+    """
+    The aliased database events are defined on the library's events class
+    every time the charm is instantiated, so drop them between the runs.
+    """
+    for name in list(vars(DatabaseRequiresEvents)):
+        if name.startswith('shard'):
+            delattr(DatabaseRequiresEvents, name)
+
+@pytest.fixture(autouse=True)
+def reset_aliased_events():
+    yield
+    drop_aliased_events()
@@ -1,7 +1,33 @@
+import collections
+import contextlib
+import dataclasses
+import gzip
+import http.server
+import importlib
+import json
+import logging
+import logging.config
 import ops
+import pathlib
+import pytest
+import socket
+import subprocess
+import sys
+import textwrap
+import threading
+import time
+import types
+import urllib.error
+import urllib.request
 from ops import testing
 
+from charms.data_platform_libs.v0.data_interfaces import DatabaseRequires
 from charm import FastAPIDemoCharm
+from hook_timings import HookTimings
+from hook_tool_stats import timed_calls
+from conftest import drop_aliased_events
+
+SRC_DIR = pathlib.Path(__file__).parents[2] / "src"
 
 def test_pebble_layer():
     ctx = testing.Context(FastAPIDemoCharm)
@@ -171,4 +197,1134 @@ def test_get_db_info_action_show_password():
         "db-port": "5432",
         "db-username": "foo",
         "db-password": "bar",
-    }
\ No newline at end of file
+    }
+
+def test_shard_map():
+    ctx = testing.Context(FastAPIDemoCharm)
+    shard0 = testing.Relation(
+        endpoint="database",
+        interface="postgresql_client",
+        remote_app_name="postgresql-k8s",
+        local_unit_data={"alias": "shard0"},
+        remote_app_data={
+            "endpoints": "example.com:5432",
+            "username": "foo",
+            "password": "bar",
+        },
+    )
+    shard1 = testing.Relation(
+        endpoint="database",
+        interface="postgresql_client",
+        remote_app_name="postgresql-k8s-1",
+        local_unit_data={"alias": "shard1"},
+        remote_app_data={
+            "endpoints": "example.org:5432",
+            "username": "baz",
+            "password": "qux",
+        },
+    )
+    container = testing.Container(name="demo-server", can_connect=True)
+    state_in = testing.State(
+        containers={container},
+        relations={shard0, shard1},
+        leader=True,
+    )
+
+    state_out = ctx.run(ctx.on.pebble_ready(container), state_in)
+
+    environment = state_out.get_container(container.name).layers["fastapi_demo"].services["fastapi-service"].environment
+    assert json.loads(environment["DEMO_SERVER_DB_SHARDS"]) == {
+        "shard0": {
+            "db_host": "example.com",
+            "db_port": "5432",
+            "db_username": "foo",
+            "db_password": "bar",
+        },
+        "shard1": {
+            "db_host": "example.org",
+            "db_port": "5432",
+            "db_username": "baz",
+            "db_password": "qux",
+        },
+    }
+
+def test_app_environment_fetches_database_data_once():
+    ctx = testing.Context(FastAPIDemoCharm)
+    shards = [
+        testing.Relation(
+            endpoint="database",
+            interface="postgresql_client",
+            remote_app_name=f"postgresql-k8s-{index}",
+            local_unit_data={"alias": f"shard{index}"},
+            remote_app_data={"endpoints": f"example-{index}.com:5432", "username": "foo", "password": "bar"},
+        )
+        for index in range(2)
+    ]
+    state_in = testing.State(
+        containers={testing.Container(name="demo-server", can_connect=True)},
+        relations=set(shards),
+        leader=True,
+    )
+
+    with ctx(ctx.on.update_status(), state_in) as manager:
+        database = manager.charm.database
+        calls = []
+        fetch_relation_data = database.fetch_relation_data
+        database.fetch_relation_data = lambda *args, **kwargs: calls.append(args) or fetch_relation_data(*args, **kwargs)
+        environment = manager.charm.app_environment
+        assert len(calls) == 1
+        manager.run()
+
+    assert environment["DEMO_SERVER_DB_HOST"] in ("example-0.com", "example-1.com")
+    assert set(json.loads(environment["DEMO_SERVER_DB_SHARDS"])) == {"shard0", "shard1"}
+
+def test_postgres_exporter_layer(tmp_path):
+    # the exporter binary shipped in the charm
+    (tmp_path / "bin").mkdir()
+    (tmp_path / "bin" / "postgres_exporter").write_bytes(b"\x7fELF")
+    ctx = testing.Context(FastAPIDemoCharm, charm_root=tmp_path)
+    container = testing.Container(name="demo-server", can_connect=True)
+    relation = testing.Relation(
+        endpoint="database",
+        interface="postgresql_client",
+        remote_app_name="postgresql-k8s",
+        remote_app_data={
+            "endpoints": "example.com:5432",
+            "username": "foo",
+            "password": "bar",
+        },
+    )
+    state_in = testing.State(
+        containers={container},
+        relations={relation},
+        config={"enable-postgres-exporter": True},
+        leader=True,
+    )
+
+    state_out = ctx.run(ctx.on.pebble_ready(container), state_in)
+
+    container_out = state_out.get_container(container.name)
+    service = container_out.layers["postgres_exporter"].services["postgres-exporter"]
+    assert service.command == "/srv/postgres-exporter/postgres_exporter --web.listen-address=:9187"
+    assert service.environment == {
+        "DATA_SOURCE_URI": "example.com:5432/names_db?sslmode=disable",
+        "DATA_SOURCE_USER": "foo",
+        "DATA_SOURCE_PASS": "bar",
+    }
+    assert container_out.service_statuses["postgres-exporter"] == ops.pebble.ServiceStatus.ACTIVE
+    assert (container_out.get_filesystem(ctx) / "srv" / "postgres-exporter" / "postgres_exporter").read_bytes() == b"\x7fELF"
+
+def test_postgres_exporter_disabled():
+    ctx = testing.Context(FastAPIDemoCharm)
+    container = testing.Container(name="demo-server", can_connect=True)
+    state_in = testing.State(
+        containers={container},
+        leader=True,
+    )
+
+    state_out = ctx.run(ctx.on.pebble_ready(container), state_in)
+
+    assert "postgres_exporter" not in state_out.get_container(container.name).layers
+
+def test_postgres_exporter_disabled_after_running():
+    ctx = testing.Context(FastAPIDemoCharm)
+    exporter_layer = ops.pebble.Layer({
+        "services": {
+            "postgres-exporter": {
+                "override": "replace",
+                "command": "/srv/postgres-exporter/postgres_exporter",
+                "startup": "enabled",
+            },
+        },
+    })
+    container = testing.Container(
+        name="demo-server",
+        can_connect=True,
+        layers={"postgres_exporter": exporter_layer},
+        service_statuses={"postgres-exporter": ops.pebble.ServiceStatus.ACTIVE},
+    )
+    state_in = testing.State(
+        containers={container},
+        config={"enable-postgres-exporter": False},
+        leader=True,
+    )
+
+    state_out = ctx.run(ctx.on.config_changed(), state_in)
+
+    container_out = state_out.get_container(container.name)
+    assert container_out.plan.services["postgres-exporter"].startup == "disabled"
+    assert container_out.service_statuses["postgres-exporter"] == ops.pebble.ServiceStatus.INACTIVE
+
+def resolve_db_state(getent: testing.Exec) -> testing.State:
+    relation = testing.Relation(
+        endpoint="database",
+        interface="postgresql_client",
+        remote_app_name="postgresql-k8s",
+        remote_app_data={
+            "endpoints": "example.com:5432",
+            "username": "foo",
+            "password": "bar",
+        },
+    )
+    return testing.State(
+        containers={testing.Container(name="demo-server", can_connect=True, execs={getent})},
+        relations={relation},
+        config={"resolve-db-host": True},
+        leader=True,
+    )
+
+def test_resolved_db_addresses():
+    ctx = testing.Context(FastAPIDemoCharm)
+    getent = testing.Exec(
+        ["getent", "ahosts", "example.com"],
+        stdout="10.0.0.2        STREAM example.com\n10.0.0.2        DGRAM\n10.0.0.1        STREAM\n",
+    )
+
+    state_out = ctx.run(ctx.on.update_status(), resolve_db_state(getent))
+
+    environment = state_out.get_container("demo-server").layers["fastapi_demo"].services["fastapi-service"].environment
+    assert environment["DEMO_SERVER_DB_HOST"] == "example.com"
+    assert environment["DEMO_SERVER_DB_ADDRS"] == "10.0.0.1,10.0.0.2"
+    assert ctx.exec_history["demo-server"][0].timeout == 5
+
+def test_resolved_db_addresses_lookup_failure():
+    ctx = testing.Context(FastAPIDemoCharm)
+    getent = testing.Exec(["getent", "ahosts", "example.com"], return_code=2)
+
+    state_out = ctx.run(ctx.on.update_status(), resolve_db_state(getent))
+
+    # nothing was resolved, so the workload isn't restarted
+    assert "fastapi_demo" not in state_out.get_container("demo-server").layers
+
+def test_db_extension_flags(monkeypatch):
+    monkeypatch.setattr(
+        DatabaseRequires,
+        "is_postgresql_plugin_enabled",
+        lambda self, plugin, relation_index=0: plugin == "pg_trgm",
+    )
+    ctx = testing.Context(FastAPIDemoCharm)
+    relation = testing.Relation(
+        endpoint="database",
+        interface="postgresql_client",
+        remote_app_name="postgresql-k8s",
+        remote_app_data={
+            "endpoints": "example.com:5432",
+            "username": "foo",
+            "password": "bar",
+        },
+    )
+    container = testing.Container(name="demo-server", can_connect=True)
+    state_in = testing.State(
+        containers={container},
+        relations={relation},
+        config={"db-extensions": "pg_trgm, btree_gin, uuid-ossp"},
+        leader=True,
+    )
+
+    state_out = ctx.run(ctx.on.relation_changed(relation), state_in)
+
+    environment = state_out.get_container(container.name).layers["fastapi_demo"].services["fastapi-service"].environment
+    assert environment["DEMO_SERVER_DB_EXT_PG_TRGM"] == "true"
+    assert environment["DEMO_SERVER_DB_EXT_BTREE_GIN"] == "false"
+    assert environment["DEMO_SERVER_DB_EXT_UUID_OSSP"] == "false"
+
+@pytest.mark.parametrize("extensions, probed", [("pg_trgm, uuid-ossp", ["pg_trgm", "uuid-ossp"]), ("pg_trgm", [])])
+def test_db_extensions_probed_on_config_change(monkeypatch, extensions, probed):
+    calls = []
+    monkeypatch.setattr(
+        DatabaseRequires,
+        "is_postgresql_plugin_enabled",
+        lambda self, plugin, relation_index=0: calls.append(plugin) or True,
+    )
+    ctx = testing.Context(FastAPIDemoCharm)
+    relation = testing.Relation(
+        endpoint="database",
+        interface="postgresql_client",
+        remote_app_name="postgresql-k8s",
+        remote_app_data={
+            "endpoints": "example.com:5432",
+            "username": "foo",
+            "password": "bar",
+        },
+    )
+    container = testing.Container(name="demo-server", can_connect=True)
+    state_in = testing.State(
+        containers={container},
+        relations={relation},
+        config={"db-extensions": extensions},
+        # pg_trgm was probed when the database was created
+        stored_states={
+            testing.StoredState(owner_path="FastAPIDemoCharm", content={"db_extensions": json.dumps({"pg_trgm": True})}),
+        },
+        leader=True,
+    )
+
+    state_out = ctx.run(ctx.on.config_changed(), state_in)
+
+    # the extensions are only probed again when their list changes
+    assert calls == probed
+    environment = state_out.get_container(container.name).layers["fastapi_demo"].services["fastapi-service"].environment
+    assert environment["DEMO_SERVER_DB_EXT_PG_TRGM"] == "true"
+    assert ("DEMO_SERVER_DB_EXT_UUID_OSSP" in environment) == ("uuid-ossp" in extensions)
+
+def test_unit_indices():
+    ctx = testing.Context(FastAPIDemoCharm)
+    relation = testing.PeerRelation(
+        endpoint="fastapi-peers",
+        local_app_data={"unit-indices": json.dumps({"demo-api-charm/0": 0, "demo-api-charm/3": 1, "demo-api-charm/4": 2})},
+        peers_data={1: {}, 4: {}},
+    )
+    container = testing.Container(name="demo-server", can_connect=True)
+    state_in = testing.State(
+        containers={container},
+        relations={relation},
+        leader=True,
+    )
+
+    state_out = ctx.run(ctx.on.relation_departed(relation, remote_unit=3, departing_unit=3), state_in)
+
+    # unit 1 takes the ordinal freed by unit 3, unit 4 keeps its own
+    indices = json.loads(state_out.get_relation(relation.id).local_app_data["unit-indices"])
+    assert indices == {"demo-api-charm/0": 0, "demo-api-charm/1": 1, "demo-api-charm/4": 2}
+
+    environment = state_out.get_container(container.name).layers["fastapi_demo"].services["fastapi-service"].environment
+    assert environment["DEMO_SERVER_UNIT_INDEX"] == "0"
+    assert environment["DEMO_SERVER_UNIT_COUNT"] == "3"
+
+def test_assign_unit_indices():
+    indices = FastAPIDemoCharm.assign_unit_indices({"app/0": 0, "app/1": 1, "app/2": 2}, {"app/0", "app/2"})
+    assert indices == {"app/0": 0, "app/2": 1}
+
+def test_multiple_workers():
+    ctx = testing.Context(FastAPIDemoCharm)
+    container = testing.Container(name="demo-server", can_connect=True)
+    state_in = testing.State(
+        containers={container},
+        config={"workers": 4},
+        leader=True,
+    )
+
+    state_out = ctx.run(ctx.on.config_changed(), state_in)
+
+    services = state_out.get_container(container.name).layers["fastapi_demo"].services
+    assert services["fastapi-service"].command == (
+        "/bin/sh -c 'rm -rf /dev/shm/prometheus-multiproc && mkdir -p /dev/shm/prometheus-multiproc && "
+        "exec uvicorn api_demo_server.app:app --host=0.0.0.0 --port=8000 --workers=4'"
+    )
+    assert services["fastapi-service"].environment["PROMETHEUS_MULTIPROC_DIR"] == "/dev/shm/prometheus-multiproc"
+    assert services["metrics-aggregator"].command == "python3 /srv/metrics_aggregator.py 9100"
+
+def test_back_to_one_worker():
+    ctx = testing.Context(FastAPIDemoCharm)
+    container = testing.Container(name="demo-server", can_connect=True)
+    state = testing.State(containers={container}, config={"workers": 2}, leader=True)
+
+    state = ctx.run(ctx.on.config_changed(), state)
+    assert state.get_container(container.name).service_statuses["metrics-aggregator"] == ops.pebble.ServiceStatus.ACTIVE
+
+    drop_aliased_events()
+    state = ctx.run(ctx.on.config_changed(), dataclasses.replace(state, config={"workers": 1}))
+
+    container_out = state.get_container(container.name)
+    assert container_out.plan.services["metrics-aggregator"].startup == "disabled"
+    assert container_out.service_statuses["metrics-aggregator"] == ops.pebble.ServiceStatus.INACTIVE
+    assert "--workers" not in container_out.plan.services["fastapi-service"].command
+
+    # a later replan doesn't start it again
+    drop_aliased_events()
+    state = ctx.run(ctx.on.config_changed(), state)
+    assert state.get_container(container.name).service_statuses["metrics-aggregator"] == ops.pebble.ServiceStatus.INACTIVE
+
+def test_scrape_jobs():
+    ctx = testing.Context(FastAPIDemoCharm)
+    container = testing.Container(name="demo-server", can_connect=True)
+    state_in = testing.State(
+        containers={container},
+        config={"metrics-port": 9200, "metrics-path": "/stats", "scrape-interval": "5m", "scrape-timeout": "30s"},
+        leader=True,
+    )
+
+    with ctx(ctx.on.config_changed(), state_in) as manager:
+        assert manager.charm._scrape_jobs == [
+            {
+                "metrics_path": "/stats",
+                "static_configs": [{"targets": ["*:9200"]}],
+                "scrape_interval": "5m",
+                "scrape_timeout": "30s",
+            }
+        ]
+        state_out = manager.run()
+
+    services = state_out.get_container(container.name).layers["fastapi_demo"].services
+    assert services["metrics-aggregator"].command == "python3 /srv/metrics_aggregator.py 9200"
+
+def test_alert_rules_thresholds():
+    ctx = testing.Context(FastAPIDemoCharm)
+    relation = testing.Relation(endpoint="metrics-endpoint", interface="prometheus_scrape")
+    state_in = testing.State(
+        containers={testing.Container(name="demo-server", can_connect=True)},
+        relations={relation},
+        config={"availability-objective": 0.99, "latency-p99-target": 0.25},
+        leader=True,
+    )
+
+    with ctx(ctx.on.config_changed(), state_in) as manager:
+        rules = (manager.charm.charm_dir / "prometheus_alert_rules" / "slo.rules").read_text()
+        manager.run()
+
+    assert "demo_server:slo_errors:ratio_rate1h > (14.4 * 0.01)" in rules
+    assert "demo_server:http_request_duration_seconds:p99_5m > 0.25" in rules
+    assert "{{ $labels.juju_application }}" in rules
+
+def test_observability_libs_only_set_up_with_their_relation():
+    ctx = testing.Context(FastAPIDemoCharm)
+    relation = testing.Relation(endpoint="metrics-endpoint", interface="prometheus_scrape")
+    containers = {testing.Container(name="demo-server", can_connect=True)}
+
+    with ctx(ctx.on.update_status(), testing.State(containers=containers)) as manager:
+        charm = manager.charm
+        assert charm._prometheus_scraping is None
+        assert charm._logging is None
+        assert charm._grafana_dashboards is None
+        assert charm.tracing is None
+        assert charm._profiling is None
+        manager.run()
+
+    drop_aliased_events()
+    with ctx(ctx.on.relation_joined(relation, remote_unit=0), testing.State(containers=containers, relations={relation})) as manager:
+        assert manager.charm._prometheus_scraping is not None
+        assert manager.charm._grafana_dashboards is None
+        manager.run()
+
+def test_pebble_log_forwarding():
+    ctx = testing.Context(FastAPIDemoCharm)
+    relation = testing.Relation(
+        endpoint="log-proxy",
+        interface="loki_push_api",
+        remote_app_name="loki-k8s",
+        remote_units_data={0: {"endpoint": json.dumps({"url": "http://loki-k8s-0:3100/loki/api/v1/push"})}},
+    )
+    container = testing.Container(name="demo-server", can_connect=True)
+    state_in = testing.State(
+        containers={container},
+        relations={relation},
+        config={"log-forwarding": "pebble", "log-labels": "team=api, tier=web"},
+        leader=True,
+    )
+
+    state_out = ctx.run(ctx.on.relation_changed(relation, remote_unit=0), state_in)
+
+    target = state_out.get_container(container.name).layers["fastapi_demo"].log_targets["loki-0"]
+    assert target.location == "http://loki-k8s-0:3100/loki/api/v1/push"
+    assert target.services == ["fastapi-service"]
+    assert target.labels["team"] == "api"
+    assert target.labels["tier"] == "web"
+    assert target.labels["juju_unit"] == "demo-api-charm/0"
+
+def test_switch_from_promtail_to_pebble_log_forwarding():
+    ctx = testing.Context(FastAPIDemoCharm)
+    relation = testing.Relation(
+        endpoint="log-proxy",
+        interface="loki_push_api",
+        remote_app_name="loki-k8s",
+        remote_units_data={0: {"endpoint": json.dumps({"url": "http://loki-k8s-0:3100/loki/api/v1/push"})}},
+    )
+    # the layer LogProxyConsumer injected with 'promtail' log forwarding
+    promtail_layer = ops.pebble.Layer({
+        "services": {"promtail": {"override": "replace", "command": "/opt/promtail/promtail-linux-amd64", "startup": "enabled"}},
+    })
+    container = testing.Container(
+        name="demo-server",
+        can_connect=True,
+        layers={"demo-server": promtail_layer},
+        service_statuses={"promtail": ops.pebble.ServiceStatus.ACTIVE},
+    )
+    state = testing.State(
+        containers={container},
+        relations={relation},
+        config={"log-forwarding": "pebble"},
+        leader=True,
+    )
+
+    state = ctx.run(ctx.on.config_changed(), state)
+
+    # the logs are only pushed by Pebble
+    container_out = state.get_container(container.name)
+    assert container_out.plan.services["promtail"].startup == "disabled"
+    assert container_out.service_statuses["promtail"] == ops.pebble.ServiceStatus.INACTIVE
+    assert container_out.plan.log_targets["loki-0"].location == "http://loki-k8s-0:3100/loki/api/v1/push"
+
+    # & promtail is back when switching back
+    drop_aliased_events()
+    state = ctx.run(ctx.on.config_changed(), dataclasses.replace(state, config={"log-forwarding": "promtail"}))
+
+    container_out = state.get_container(container.name)
+    assert container_out.plan.services["promtail"].startup == "enabled"
+    assert container_out.service_statuses["promtail"] == ops.pebble.ServiceStatus.ACTIVE
+
+@contextlib.contextmanager
+def applied_logging_config(logging_config, tmp_path, monkeypatch):
+    """
+    Apply a logging config pushed by the charm in `tmp_path`, the way uvicorn does,
+    & restore the root logger of the tests afterwards
+    """
+    monkeypatch.chdir(tmp_path)
+    root = logging.getLogger()
+    handlers, level = root.handlers[:], root.level
+    logging.config.dictConfig(logging_config)
+    try:
+        yield
+    finally:
+        for handler in root.handlers:
+            handler.close()
+        root.handlers[:] = handlers
+        root.setLevel(level)
+
+def test_log_rotation(tmp_path, monkeypatch):
+    ctx = testing.Context(FastAPIDemoCharm)
+    container = testing.Container(name="demo-server", can_connect=True)
+    state_in = testing.State(
+        containers={container},
+        config={"log-rotate-size": 10, "log-rotate-count": 3, "log-buffer-size": 100},
+        leader=True,
+    )
+
+    state_out = ctx.run(ctx.on.config_changed(), state_in)
+
+    container_out = state_out.get_container(container.name)
+    assert "--log-config=/srv/logging.json" in container_out.layers["fastapi_demo"].services["fastapi-service"].command
+
+    logging_config = json.loads((container_out.get_filesystem(ctx) / "srv" / "logging.json").read_text())
+    assert logging_config["handlers"]["file"] == {
+        "class": "logging.handlers.RotatingFileHandler",
+        "filename": "demo_server.log",
+        "formatter": "default",
+        "maxBytes": 10 * 1024 * 1024,
+        "backupCount": 3,
+    }
+    assert logging_config["root"]["handlers"] == ["buffered"]
+
+    # the INFO record waits in the buffer, the ERROR one flushes both to the file
+    with applied_logging_config(logging_config, tmp_path, monkeypatch):
+        logging.getLogger("uvicorn").info("started")
+        assert not (tmp_path / "demo_server.log").read_text()
+        logging.getLogger("uvicorn").error("failed")
+        started, failed = (tmp_path / "demo_server.log").read_text().splitlines()
+        assert started.endswith("INFO uvicorn started")
+        assert failed.endswith("ERROR uvicorn failed")
+
+def test_log_rotation_with_pebble_log_forwarding():
+    ctx = testing.Context(FastAPIDemoCharm)
+    container = testing.Container(name="demo-server", can_connect=True)
+    state_in = testing.State(
+        containers={container},
+        config={"log-rotate-size": 10, "log-buffer-size": 100, "log-forwarding": "pebble"},
+        leader=True,
+    )
+
+    state_out = ctx.run(ctx.on.config_changed(), state_in)
+
+    logging_config = json.loads((state_out.get_container(container.name).get_filesystem(ctx) / "srv" / "logging.json").read_text())
+    # the file stays buffered, while Pebble gets every record right away
+    assert logging_config["root"]["handlers"] == ["buffered", "console"]
+    assert logging_config["handlers"]["console"] == {"class": "logging.StreamHandler", "formatter": "default"}
+    assert logging_config["handlers"]["buffered"]["target"] == "file"
+
+def test_request_logging():
+    ctx = testing.Context(FastAPIDemoCharm)
+    container = testing.Container(name="demo-server", can_connect=True)
+    state_in = testing.State(
+        containers={container},
+        config={"access-log-sample-rate": 0.1, "slow-request-threshold": 0.5, "log-format": "json"},
+        leader=True,
+    )
+
+    state_out = ctx.run(ctx.on.config_changed(), state_in)
+
+    container_out = state_out.get_container(container.name)
+    service = container_out.layers["fastapi_demo"].services["fastapi-service"]
+    assert service.command == (
+        "uvicorn request_logging:app --host=0.0.0.0 --port=8000 --app-dir=/srv --no-access-log"
+    )
+    assert service.environment == {
+        "DEMO_SERVER_ACCESS_LOG_SAMPLE_RATE": "0.1",
+        "DEMO_SERVER_LOG_FORMAT": "json",
+        "DEMO_SERVER_SLOW_REQUEST_THRESHOLD": "0.5",
+    }
+    assert (container_out.get_filesystem(ctx) / "srv" / "request_logging.py").exists()
+
+def test_request_logging_json_with_log_buffer(tmp_path, monkeypatch):
+    ctx = testing.Context(FastAPIDemoCharm)
+    container = testing.Container(name="demo-server", can_connect=True)
+    state_in = testing.State(
+        containers={container},
+        config={"log-format": "json", "log-buffer-size": 100},
+        leader=True,
+    )
+
+    state_out = ctx.run(ctx.on.config_changed(), state_in)
+
+    container_out = state_out.get_container(container.name)
+    environment = container_out.layers["fastapi_demo"].services["fastapi-service"].environment
+    logging_config = json.loads((container_out.get_filesystem(ctx) / "srv" / "logging.json").read_text())
+    # the wrapper is imported by uvicorn once it has applied the logging config, the demo app isn't needed
+    for name, value in environment.items():
+        monkeypatch.setenv(name, value)
+    monkeypatch.setitem(sys.modules, "api_demo_server", types.ModuleType("api_demo_server"))
+    monkeypatch.setitem(sys.modules, "api_demo_server.app", types.SimpleNamespace(app=None))
+    with applied_logging_config(logging_config, tmp_path, monkeypatch):
+        try:
+            importlib.import_module("request_logging")
+        finally:
+            sys.modules.pop("request_logging", None)
+        logging.getLogger("uvicorn.error").error("failed")
+
+        entry = json.loads((tmp_path / "demo_server.log").read_text())
+    assert entry["level"] == "ERROR"
+    assert entry["message"] == "failed"
+
+def test_tracing_environment():
+    ctx = testing.Context(FastAPIDemoCharm)
+    relation = testing.Relation(
+        endpoint="tracing",
+        interface="tracing",
+        remote_app_name="tempo",
+        remote_app_data={
+            "receivers": json.dumps([{"protocol": {"name": "otlp_http", "type": "http"}, "url": "http://tempo:4318"}]),
+        },
+    )
+    container = testing.Container(name="demo-server", can_connect=True)
+    state_in = testing.State(
+        containers={container},
+        relations={relation},
+        config={"tracing-sample-rate": 0.25},
+        leader=True,
+    )
+
+    state_out = ctx.run(ctx.on.relation_changed(relation), state_in)
+
+    environment = state_out.get_container(container.name).layers["fastapi_demo"].services["fastapi-service"].environment
+    assert environment["OTEL_EXPORTER_OTLP_ENDPOINT"] == "http://tempo:4318"
+    assert environment["OTEL_SERVICE_NAME"] == "demo-api-charm"
+    assert "juju_unit=demo-api-charm/0" in environment["OTEL_RESOURCE_ATTRIBUTES"]
+    assert environment["OTEL_TRACES_SAMPLER"] == "parentbased_traceidratio"
+    assert environment["OTEL_TRACES_SAMPLER_ARG"] == "0.25"
+
+def test_charm_tracing_destination(monkeypatch):
+    destinations = []
+    monkeypatch.setattr(ops.tracing, "set_destination", lambda url, ca: destinations.append(url))
+    ctx = testing.Context(FastAPIDemoCharm)
+    relation = testing.Relation(
+        endpoint="tracing",
+        interface="tracing",
+        remote_app_name="tempo",
+        remote_app_data={
+            "receivers": json.dumps([{"protocol": {"name": "otlp_http", "type": "http"}, "url": "http://tempo:4318"}]),
+        },
+    )
+    state_in = testing.State(
+        containers={testing.Container(name="demo-server", can_connect=True)},
+        relations={relation},
+        leader=True,
+    )
+
+    ctx.run(ctx.on.update_status(), state_in)
+
+    assert destinations == ["http://tempo:4318/v1/traces"]
+
+def test_profiling_environment():
+    ctx = testing.Context(FastAPIDemoCharm)
+    relation = testing.Relation(endpoint="profiling-endpoint", interface="parca_scrape", remote_app_name="parca")
+    container = testing.Container(name="demo-server", can_connect=True)
+    state_in = testing.State(
+        containers={container},
+        relations={relation},
+        leader=True,
+    )
+
+    with ctx(ctx.on.relation_joined(relation), state_in) as manager:
+        state_out = manager.run()
+        jobs = manager.charm._profiling_jobs
+
+    service = state_out.get_container(container.name).layers["fastapi_demo"].services["fastapi-service"]
+    assert service.command.startswith("/bin/sh -c 'export PYTHONPATH=/srv/site-modules${PYTHONPATH:+:$PYTHONPATH}")
+    assert service.environment == {
+        "DEMO_SERVER_SITE_MODULES": "pprof_profiling",
+        "DEMO_SERVER_PROFILING_PORT": "8081",
+        "DEMO_SERVER_PROFILING_SAMPLE_RATE": "100",
+        "DEMO_SERVER_PROFILING_DIR": "/dev/shm/pprof-profiling",
+    }
+    site_modules = state_out.get_container(container.name).get_filesystem(ctx) / "srv" / "site-modules"
+    assert (site_modules / "pprof_profiling.py").exists()
+    assert jobs[0]["static_configs"] == [{"targets": ["*:8081"]}]
+    assert jobs[0]["profiling_config"]["pprof_config"]["process_cpu"]["path"] == "/debug/pprof/profile"
+
+def test_pprof_profiling(tmp_path):
+    # a workload process with the profiler loaded, busy for a while
+    site_modules = tmp_path / "site-modules"
+    site_modules.mkdir()
+    (site_modules / "sitecustomize.py").write_text((SRC_DIR / "workload_sitecustomize.py").read_text())
+    (site_modules / "pprof_profiling.py").write_text((SRC_DIR / "pprof_profiling.py").read_text())
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    workload = subprocess.Popen(
+        [sys.executable, "-c", textwrap.dedent("""
+            def busy_handler():
+                while True:
+                    sum(range(1000))
+            busy_handler()
+        """)],
+        env={
+            "PYTHONPATH": str(site_modules),
+            "DEMO_SERVER_SITE_MODULES": "pprof_profiling",
+            "DEMO_SERVER_PROFILING_PORT": str(port),
+            "DEMO_SERVER_PROFILING_DIR": str(tmp_path / "stacks"),
+        },
+    )
+
+    try:
+        for _ in range(50):
+            try:
+                with urllib.request.urlopen(f"http://127.0.0.1:{port}/debug/pprof/profile?seconds=1", timeout=10) as response:
+                    profile = gzip.decompress(response.read())
+                break
+            except urllib.error.URLError:
+                time.sleep(0.1)
+        else:
+            pytest.fail("The profiler didn't serve the profile")
+    finally:
+        workload.kill()
+        workload.wait()
+
+    # the function & sample type names are in the string table of the protobuf
+    assert b"busy_handler" in profile
+    assert b"nanoseconds" in profile
+
+def test_perf_report_action():
+    ctx = testing.Context(FastAPIDemoCharm)
+    container = testing.Container(name="demo-server", can_connect=True)
+    state = testing.State(
+        containers={container},
+        config={"hook-metrics-port": 9102},
+        leader=True,
+    )
+
+    state = ctx.run(ctx.on.config_changed(), state)
+    drop_aliased_events()
+    state = ctx.run(ctx.on.config_changed(), state)
+    metrics = (state.get_container(container.name).get_filesystem(ctx) / "srv" / "charm-metrics" / "metrics.txt").read_text()
+    assert 'charm_hook_duration_seconds_count{key="dispatch/config-changed"} 2' in metrics
+    assert 'charm_hook_duration_seconds_sum{key="dispatch/config-changed"}' in metrics
+    assert "charm-metrics" in state.get_container(container.name).layers["charm_metrics"].services
+
+    drop_aliased_events()
+    state = ctx.run(ctx.on.action("perf-report"), state)
+
+    assert ctx.action_results["dispatch-config-changed"]["count"] == "2"
+    assert ctx.action_results["config-changed-on-config-changed"]["count"] == "2"
+    assert set(ctx.action_results["collect-unit-status-on-collect-status"]) == {"count", "p50", "p95", "max"}
+    # the action doesn't push the timings
+    assert not (state.get_container(container.name).get_filesystem(ctx) / "srv" / "charm-metrics").exists()
+
+def test_hook_metrics_disabled():
+    ctx = testing.Context(FastAPIDemoCharm)
+    container = testing.Container(name="demo-server", can_connect=True)
+    state = testing.State(containers={container}, config={"hook-metrics-port": 9102}, leader=True)
+
+    state = ctx.run(ctx.on.config_changed(), state)
+    assert state.get_container(container.name).service_statuses["charm-metrics"] == ops.pebble.ServiceStatus.ACTIVE
+
+    drop_aliased_events()
+    state = ctx.run(ctx.on.config_changed(), dataclasses.replace(state, config={"hook-metrics-port": 0}))
+    container_out = state.get_container(container.name)
+    assert container_out.plan.services["charm-metrics"].startup == "disabled"
+    assert container_out.service_statuses["charm-metrics"] == ops.pebble.ServiceStatus.INACTIVE
+
+    # setting the port again starts it again
+    drop_aliased_events()
+    state = ctx.run(ctx.on.config_changed(), dataclasses.replace(state, config={"hook-metrics-port": 9102}))
+    assert state.get_container(container.name).service_statuses["charm-metrics"] == ops.pebble.ServiceStatus.ACTIVE
+
+def test_hook_timings_totals():
+    timings = HookTimings(json.dumps({"dispatch/start": [1.0]}), size=2)
+    for duration in (2.0, 3.0, 4.0):
+        timings.record("dispatch/start", duration)
+
+    # the count & sum go on past the buffer, the quantiles don't
+    timings = HookTimings(timings.dumps(), size=2, totals=timings.dumps_totals())
+    metrics = timings.to_prometheus()
+    assert 'charm_hook_duration_seconds_count{key="dispatch/start"} 4' in metrics
+    assert 'charm_hook_duration_seconds_sum{key="dispatch/start"} 10.0' in metrics
+    assert 'charm_hook_duration_seconds{key="dispatch/start",quantile="1"} 4.0' in metrics
+    assert timings.report()["dispatch/start"]["count"] == 2
+
+def test_hook_tool_stats():
+    ctx = testing.Context(FastAPIDemoCharm)
+    relation = testing.Relation(
+        endpoint="database",
+        interface="postgresql_client",
+        remote_app_name="postgresql-k8s",
+        remote_app_data={
+            "endpoints": "example.com:5432",
+            "username": "foo",
+            "password": "bar",
+        },
+    )
+    state_in = testing.State(
+        containers={testing.Container(name="demo-server", can_connect=True)},
+        relations={relation},
+        config={"instrument-hook-tools": True},
+        leader=True,
+    )
+
+    with ctx(ctx.on.relation_changed(relation), state_in) as manager:
+        manager.run()
+        summary = manager.charm.hook_tool_stats.summary()
+
+    assert summary["relation-get"]["count"] > 0
+    assert any(caller.startswith("data_interfaces.py:") for caller in summary["relation-get"]["callers"])
+    assert summary["relation-set"]["count"] > 0
+
+
+# ----- backend-call budgets -----
+# the maximum number of hook tool & Pebble calls each event may make, a change that
+# makes more of them has to raise the budget here on purpose
+PEBBLE_METHODS = [
+    "add_layer", "replan", "get_plan", "get_services", "get_service", "push", "pull",
+    "start", "stop", "restart", "exists", "list_files", "make_dir", "remove_path", "exec",
+]
+
+# every dispatch also runs collect-status, its calls are part of each budget
+BUDGETS = {
+    "pebble-ready": {"relation-get": 3, "secret-get": 6, "pebble": 7},
+    "config-changed": {"relation-get": 3, "secret-get": 6, "pebble": 7},
+    "database-relation-changed": {"relation-get": 3, "secret-get": 6, "pebble": 7},
+    "collect-status": {"relation-get": 3, "secret-get": 4, "pebble": 4},
+    "get-db-info": {"relation-get": 3, "secret-get": 4, "pebble": 2},
+}
+
+@pytest.fixture
+def pebble_calls(monkeypatch):
+    """
+    Count the calls of the Pebble API made through the containers
+    """
+    calls = collections.Counter()
+
+    def record(name, seconds):
+        calls[name] += 1
+
+    for name, wrapper in timed_calls(ops.Container, PEBBLE_METHODS, record).items():
+        monkeypatch.setattr(ops.Container, name, wrapper)
+
+    return calls
+
+def budget_event(ctx, name, relation, container):
+    return {
+        "pebble-ready": lambda: ctx.on.pebble_ready(container),
+        "config-changed": lambda: ctx.on.config_changed(),
+        "database-relation-changed": lambda: ctx.on.relation_changed(relation, remote_unit=0),
+        "collect-status": lambda: ctx.on.collect_unit_status(),
+        "get-db-info": lambda: ctx.on.action("get-db-info", params={"show-password": True}),
+    }[name]()
+
+@pytest.mark.parametrize("event_name", BUDGETS)
+def test_backend_call_budget(event_name, pebble_calls):
+    ctx = testing.Context(FastAPIDemoCharm)
+    relation = testing.Relation(
+        endpoint="database",
+        interface="postgresql_client",
+        remote_app_name="postgresql-k8s",
+        remote_app_data={
+            "endpoints": "example.com:5432",
+            "username": "foo",
+            "password": "bar",
+        },
+    )
+    container = testing.Container(name="demo-server", can_connect=True)
+    state_in = testing.State(
+        containers={container},
+        relations={relation},
+        config={"instrument-hook-tools": True},
+        leader=True,
+    )
+
+    with ctx(budget_event(ctx, event_name, relation, container), state_in) as manager:
+        manager.run()
+        summary = manager.charm.hook_tool_stats.summary()
+
+    calls = {
+        "relation-get": summary.get("relation-get", {}).get("count", 0),
+        "secret-get": summary.get("secret-get", {}).get("count", 0),
+        "pebble": sum(pebble_calls.values()),
+    }
+    for kind, budget in BUDGETS[event_name].items():
+        assert calls[kind] <= budget, f"{event_name} made {calls[kind]} {kind} calls, the budget is {budget}"
+
+@pytest.fixture
+def stand_in_server():
+    """
+    A local HTTP server standing in for the workload: 200 on /version, 500 elsewhere
+    """
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            body = b'{"version": "1.0.0"}'
+            self.send_response(200 if self.path == "/version" else 500)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_port}"
+    server.shutdown()
+    server.server_close()
+
+def load_test_state() -> testing.State:
+    return testing.State(
+        containers={testing.Container(name="demo-server", can_connect=True)},
+        leader=True,
+    )
+
+def test_load_test_action(stand_in_server):
+    ctx = testing.Context(FastAPIDemoCharm)
+    params = {"target": stand_in_server, "path": "/version", "duration": 1, "concurrency": 2, "rps": 50}
+
+    ctx.run(ctx.on.action("load-test", params=params), load_test_state())
+
+    results = ctx.action_results
+    # the requests are capped at 50 per second
+    assert 0 < int(results["requests"]) <= 51
+    assert results["errors"] == "0"
+    assert set(results["latency"]) == {"p50", "p90", "p99", "max"}
+    assert float(results["latency"]["p50"]) <= float(results["latency"]["max"])
+
+def test_load_test_action_errors(stand_in_server):
+    ctx = testing.Context(FastAPIDemoCharm)
+    params = {"target": stand_in_server, "path": "/missing", "duration": 1, "concurrency": 1, "rps": 20}
+
+    ctx.run(ctx.on.action("load-test", params=params), load_test_state())
+
+    results = ctx.action_results
+    assert results["errors"] == results["requests"]
+    assert results["error-kinds"] == {"http-500": results["requests"]}
+
+def test_load_test_action_invalid_target():
+    ctx = testing.Context(FastAPIDemoCharm)
+
+    with pytest.raises(testing.ActionFailed, match="invalid URL"):
+        ctx.run(
+            ctx.on.action(
+                "load-test",
+                params={"target": "ftp://example.com", "path": "/version", "duration": 1, "concurrency": 1, "rps": 0},
+            ),
+            load_test_state(),
+        )
+
+COLLAPSED_STACKS = """\
+process 42:"uvicorn api_demo_server.app:app";run (uvicorn/main.py:577);handle (api_demo_server/app.py:20);json_dumps (json/encoder.py:199) 30
+process 42:"uvicorn api_demo_server.app:app";run (uvicorn/main.py:577);handle (api_demo_server/app.py:20) 10
+process 43:"uvicorn api_demo_server.app:app";run (uvicorn/main.py:577);select (selectors.py:468) 60
+"""
+
+# CapEff with & without CAP_SYS_PTRACE (bit 19)
+PTRACE_CAPABILITIES = "00000000a80c25fb"
+DEFAULT_CAPABILITIES = "00000000a80425fb"
+
+def profile_cpu_state(tmp_path, py_spy: testing.Exec, capabilities: str = PTRACE_CAPABILITIES) -> testing.State:
+    # the /proc of the workload container: Pebble, the main uvicorn process & a worker
+    proc = tmp_path / "proc"
+    for pid, cmdline in {"1": b"/charm/bin/pebble\0run", "42": b"uvicorn\0app:app", "43": b"python3\0-c"}.items():
+        (proc / pid).mkdir(parents=True)
+        (proc / pid / "cmdline").write_bytes(cmdline)
+    (proc / "self").mkdir()
+    (proc / "self" / "status").write_text(f"Name:\tpebble\nCapEff:\t{capabilities}\n")
+    (tmp_path / "profiles").mkdir()
+
+    container = testing.Container(
+        name="demo-server",
+        can_connect=True,
+        execs={py_spy},
+        mounts={
+            "proc": testing.Mount(location="/proc", source=proc),
+            "profiles": testing.Mount(location="/srv/profiles", source=tmp_path / "profiles"),
+        },
+    )
+    return testing.State(
+        containers={container},
+        leader=True,
+    )
+
+def profile_cpu_context(tmp_path) -> testing.Context:
+    charm_root = tmp_path / "charm"
+    (charm_root / "bin").mkdir(parents=True)
+    (charm_root / "bin" / "py-spy").write_bytes(b"\x7fELF")
+    return testing.Context(FastAPIDemoCharm, charm_root=charm_root)
+
+def test_profile_cpu_action(tmp_path, monkeypatch):
+    ctx = profile_cpu_context(tmp_path)
+    monkeypatch.setattr("time.strftime", lambda format: "20261019-120000")
+    state_in = profile_cpu_state(tmp_path, testing.Exec(["/srv/py-spy/py-spy", "record"]))
+    # py-spy isn't really run, the profile it would save is already there, next to older ones
+    profiles = tmp_path / "profiles"
+    (profiles / "cpu-20261019-120000.txt").write_text(COLLAPSED_STACKS)
+    for day in range(10, 20):
+        (profiles / f"cpu-202610{day}-000000.txt").write_text("")
+
+    state_out = ctx.run(ctx.on.action("profile-cpu", params={"duration": 5, "rate": 100, "top": 2}), state_in)
+
+    results = ctx.action_results
+    assert results["path"] == "/srv/profiles/cpu-20261019-120000.txt"
+    assert results["samples"] == "100"
+    assert results["top-frames"] == {
+        "1": "select (selectors.py:468): self 60.0%, total 60.0%",
+        "2": "json_dumps (json/encoder.py:199): self 30.0%, total 30.0%",
+    }
+    assert ctx.exec_history["demo-server"][-1].command == [
+        "/srv/py-spy/py-spy", "record", "--pid", "42", "--subprocesses", "--nonblocking", "--duration", "5",
+        "--rate", "100", "--format", "raw", "--output", "/srv/profiles/cpu-20261019-120000.txt",
+    ]
+    fs = state_out.get_container("demo-server").get_filesystem(ctx)
+    assert (fs / "srv" / "py-spy" / "py-spy").read_bytes() == b"\x7fELF"
+    # the oldest profile is removed, the latest 10 are kept
+    assert sorted(path.name for path in profiles.iterdir())[0] == "cpu-20261011-000000.txt"
+    assert len(list(profiles.iterdir())) == 10
+
+def test_profile_cpu_action_failure(tmp_path):
+    ctx = profile_cpu_context(tmp_path)
+    state_in = profile_cpu_state(
+        tmp_path, testing.Exec(["/srv/py-spy/py-spy"], return_code=1, stderr="Permission denied (os error 13)")
+    )
+
+    with pytest.raises(testing.ActionFailed, match="py-spy failed: Permission denied"):
+        ctx.run(ctx.on.action("profile-cpu", params={"duration": 5, "rate": 100, "top": 2}), state_in)
+
+def test_profile_cpu_action_without_ptrace(tmp_path):
+    ctx = profile_cpu_context(tmp_path)
+    state_in = profile_cpu_state(tmp_path, testing.Exec(["/srv/py-spy/py-spy"]), DEFAULT_CAPABILITIES)
+
+    with pytest.raises(testing.ActionFailed, match="lacks the SYS_PTRACE capability"):
+        ctx.run(ctx.on.action("profile-cpu", params={"duration": 5, "rate": 100, "top": 2}), state_in)
+    assert not ctx.exec_history
+
+def test_memory_profiling_environment():
+    ctx = testing.Context(FastAPIDemoCharm)
+    container = testing.Container(name="demo-server", can_connect=True)
+    state_in = testing.State(
+        containers={container},
+        config={"memory-profiling-frames": 5},
+    )
+
+    state_out = ctx.run(ctx.on.config_changed(), state_in)
+
+    service = state_out.get_container(container.name).layers["fastapi_demo"].services["fastapi-service"]
+    # the PYTHONPATH of the image is kept behind the charm's modules
+    assert service.command.startswith(
+        "/bin/sh -c 'export PYTHONPATH=/srv/site-modules${PYTHONPATH:+:$PYTHONPATH} && exec uvicorn "
+    )
+    assert "PYTHONPATH" not in service.environment
+    assert service.environment["DEMO_SERVER_SITE_MODULES"] == "memory_profiling"
+    assert service.environment["DEMO_SERVER_TRACEMALLOC_FRAMES"] == "5"
+    assert service.environment["DEMO_SERVER_MEMORY_PROFILES_DIR"] == "/srv/profiles"
+    site_modules = state_out.get_container(container.name).get_filesystem(ctx) / "srv" / "site-modules"
+    assert "DEMO_SERVER_SITE_MODULES" in (site_modules / "sitecustomize.py").read_text()
+    assert "tracemalloc.start(FRAMES)" in (site_modules / "memory_profiling.py").read_text()
+
+def test_workload_sitecustomize(tmp_path):
+    # the charm's modules & a sitecustomize further down the path, e.g. that of the distro
+    site_modules, distro = tmp_path / "site-modules", tmp_path / "distro"
+    site_modules.mkdir()
+    distro.mkdir()
+    (site_modules / "sitecustomize.py").write_text((SRC_DIR / "workload_sitecustomize.py").read_text())
+    (site_modules / "charm_module.py").write_text("print('charm module')")
+    (distro / "sitecustomize.py").write_text("print('distro sitecustomize')")
+
+    process = subprocess.run(
+        [sys.executable, "-c", "pass"],
+        env={"PYTHONPATH": f"{site_modules}:{distro}", "DEMO_SERVER_SITE_MODULES": "charm_module"},
+        capture_output=True, text=True, check=True,
+    )
+
+    assert process.stdout.splitlines() == ["charm module", "distro sitecustomize"]
+
+def memory_profile(pid: int, ended: float, sites: dict[str, int], types: dict[str, int]) -> str:
+    return json.dumps({
+        "pid": pid,
+        "started": ended - 1,
+        "ended": ended,
+        "size_diff": sum(sites.values()),
+        "sites": [{"site": site, "size_diff": size, "count_diff": size // 1024} for site, size in sites.items()],
+        "types": types,
+    })
+
+def profile_memory_state(tmp_path, environment: dict[str, str]) -> testing.State:
+    service = {"command": "uvicorn", "environment": environment}
+    container = testing.Container(
+        name="demo-server",
+        can_connect=True,
+        layers={"fastapi_demo": ops.pebble.Layer({"services": {"fastapi-service": service}})},
+        service_statuses={"fastapi-service": ops.pebble.ServiceStatus.ACTIVE},
+        mounts={"profiles": testing.Mount(location="/srv/profiles", source=tmp_path)},
+    )
+    return testing.State(
+        containers={container},
+        config={"memory-profiling-frames": 5, "workers": 1},
+    )
+
+def test_profile_memory_action(tmp_path, monkeypatch):
+    ctx = testing.Context(FastAPIDemoCharm)
+    # a comparison left by a previous run
+    (tmp_path / "memory-9.json").write_text(memory_profile(9, 4102444800, {"stale.py:1": 1048576}, {"str": 1}))
+    signals = []
+
+    def send_signal(self, sig, *service_names):
+        signals.append(sig)
+        if sig == "SIGUSR2":
+            # the comparisons the workers write once signalled
+            (tmp_path / "memory-10.json").write_text(
+                memory_profile(10, 4102444800, {"app.py:20": 20480, "cache.py:7": 4096}, {"dict": 300})
+            )
+            (tmp_path / "memory-11.json").write_text(
+                memory_profile(11, 4102444800, {"app.py:20": 10240}, {"dict": 100, "list": 50})
+            )
+
+    monkeypatch.setattr(ops.Container, "send_signal", send_signal)
+    state_in = profile_memory_state(tmp_path, {
+        "DEMO_SERVER_SITE_MODULES": "memory_profiling",
+        "DEMO_SERVER_TRACEMALLOC_FRAMES": "5",
+    })
+
+    ctx.run(ctx.on.action("profile-memory", params={"interval": 1, "top": 2}), state_in)
+
+    assert signals == ["SIGUSR1", "SIGUSR2"]
+    assert not (tmp_path / "memory-9.json").exists()
+    results = ctx.action_results
+    assert results["processes"] == "2"
+    assert results["growth"] == "+34.0 KiB"
+    assert results["top-sites"] == {
+        "1": "app.py:20: +30.0 KiB in +30 blocks",
+        "2": "cache.py:7: +4.0 KiB in +4 blocks",
+    }
+    assert results["top-types"] == {"1": "dict: +400", "2": "list: +50"}
+
+def test_profile_memory_action_without_the_module(tmp_path, monkeypatch):
+    ctx = testing.Context(FastAPIDemoCharm)
+    signals = []
+    monkeypatch.setattr(ops.Container, "send_signal", lambda self, sig, *service_names: signals.append(sig))
+    # the config is set, but the service still runs without the heap snapshots module
+    state_in = profile_memory_state(tmp_path, {})
+
+    with pytest.raises(testing.ActionFailed, match="runs without memory profiling"):
+        ctx.run(ctx.on.action("profile-memory", params={"interval": 1, "top": 2}), state_in)
+    assert not signals
+
+def test_profile_memory_action_disabled():
+    ctx = testing.Context(FastAPIDemoCharm)
+
+    with pytest.raises(testing.ActionFailed, match="Memory profiling is disabled"):
+        ctx.run(ctx.on.action("profile-memory", params={"interval": 1, "top": 2}), load_test_state())